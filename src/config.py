@@ -1,4 +1,6 @@
 import os
+import threading
+from contextlib import contextmanager
 
 
 class Config:
@@ -70,6 +72,11 @@ class Config:
         self.ENV_FILES_CREATE_ROOT = get_bool_env("ENV_FILES_CREATE_ROOT", "false")
         self.ENV_FILES_FORMAT = os.getenv("ENV_FILES_FORMAT", "auto").lower()
 
+        # Local cache of tools already installed on each host (empty disables it)
+        self.HOST_STATE_CACHE = get_env(
+            "HOST_STATE_CACHE", os.path.expanduser("~/.cache/metaldeploy/host_state.sqlite")
+        )
+
         # Build Artifacts
         artifacts = get_env("COPY_ARTIFACTS")
         self.COPY_ARTIFACTS = []
@@ -86,8 +93,37 @@ class Config:
 
         # Global state for temporary files
         self.SSH_KEY_PATH = None
-        self.GIT_SSH_KEY_PATH = None
+        self.GIT_SSH_KEY_CONTENT = None
         self.AUTH_GIT_URL = None
 
 
-config = Config()
+class _ConfigProxy:
+    """Routes attribute access to the Config bound to the current thread, or the global one"""
+
+    def __init__(self, default):
+        object.__setattr__(self, "_default", default)
+        object.__setattr__(self, "_local", threading.local())
+
+    def _target(self):
+        return getattr(self._local, "config", None) or self._default
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._target(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._target(), name)
+
+    @contextmanager
+    def bind(self, overrides=None):
+        """Give the current thread its own Config built from overrides (used by multi-host workers)"""
+        self._local.config = Config(overrides)
+        try:
+            yield self._local.config
+        finally:
+            self._local.config = None
+
+
+config = _ConfigProxy(Config())
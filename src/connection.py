@@ -1,9 +1,22 @@
 import base64
+import hashlib
 import os
+import stat
 import tempfile
 
+import paramiko
+
 from src import config
 
+# Remote record of the last uploaded digest per artifact target, used to skip identical uploads.
+# Kept in the deploy user's home (mode 700) so other users can't plant records; $HOME is
+# expanded by the remote shell
+ARTIFACT_MARKER_DIR = "$HOME/.cache/metaldeploy-artifacts"
+
+# SFTP channel window for artifact uploads; paramiko's 2 MB default stalls pipelined writes
+# waiting for window adjustments on high-latency links
+SFTP_WINDOW_SIZE = 16 * 1024 * 1024
+
 
 def setup_ssh_key():
     """Setup SSH key file from environment variable (supports raw or base64 encoded)"""
@@ -23,18 +36,29 @@ def setup_ssh_key():
         os.chmod(config.SSH_KEY_PATH, 0o600)
 
 
-def run_command(conn, command: str, force_sudo: bool = False, use_shell_profile: bool = True):
-    """Run a command on the remote host with environment setup and sudo support"""
+def run_command(
+    conn,
+    command: str,
+    force_sudo: bool = False,
+    use_shell_profile: bool = True,
+    in_stream=None,
+):
+    """Run a command on the remote host with environment setup and sudo support
+
+    in_stream (a file-like object) is fed to the command's stdin. It can't be combined
+    with password sudo on the profile path, where stdin carries the password.
+    """
     use_sudo_for_this = config.USE_SUDO or force_sudo
+    stream_kwargs = {"in_stream": in_stream} if in_stream is not None else {}
 
     if not use_sudo_for_this and not use_shell_profile:
-        return conn.run(command, warn=False)
+        return conn.run(command, warn=False, **stream_kwargs)
 
     if not use_shell_profile:
         # Just sudo without the expensive profile loading
         # Wrap in bash -c to ensure sudo applies to the entire pipeline/batch
         escaped_command = command.replace("'", "'\"'\"'")
-        return conn.run(f"sudo bash -c '{escaped_command}'", warn=False)
+        return conn.run(f"sudo bash -c '{escaped_command}'", warn=False, **stream_kwargs)
 
     if config.REMOTE_USER == "root":
         home_dir = "/root"
@@ -63,11 +87,20 @@ def run_command(conn, command: str, force_sudo: bool = False, use_shell_profile:
     )
 
     if config.REMOTE_PASSWORD:
+        if in_stream is not None:
+            raise ValueError("in_stream is not supported with password sudo and shell profile")
         escaped_pwd = config.REMOTE_PASSWORD.replace("'", "'\"'\"'")
         full_command = f"printf '%s\\n' '{escaped_pwd}' | sudo -S {wrapped_command}"
         return conn.run(full_command, pty=False, warn=False)
     else:
-        return conn.run(f"sudo {wrapped_command}", warn=False)
+        return conn.run(f"sudo {wrapped_command}", warn=False, **stream_kwargs)
+
+
+def probe_installed(conn, tools):
+    """Return the subset of tools found on the remote PATH, probed in one round trip"""
+    result = conn.run(f"command -v {' '.join(tools)}", warn=True, hide=True)
+    found = {os.path.basename(line.strip()) for line in result.stdout.splitlines()}
+    return {tool for tool in tools if tool in found}
 
 
 def install_dependencies(conn):
@@ -80,11 +113,8 @@ def install_dependencies(conn):
         "libssl-dev",
         "libffi-dev",
     ]
-    missing = []
-    for dep in deps:
-        result = conn.run(f"which {dep}", warn=True, hide=True)
-        if not result.stdout.strip():
-            missing.append(dep)
+    installed = probe_installed(conn, deps)
+    missing = [dep for dep in deps if dep not in installed]
 
     if missing:
         print(f"======= Installing dependencies: {', '.join(missing)} =======")
@@ -95,6 +125,45 @@ def install_dependencies(conn):
         print("======= All dependencies already installed =======")
 
 
+def open_sftp(conn):
+    """Open an SFTP session with a large window for artifact uploads; the caller closes it"""
+    # conn.sftp() would open Fabric's shared client with paramiko's default window
+    conn.open()
+    return paramiko.SFTPClient.from_transport(conn.transport, window_size=SFTP_WINDOW_SIZE)
+
+
+def _artifact_digest(local_path):
+    """sha256 over an artifact's content, modes and symlink targets (relative paths for a directory)"""
+    digest = hashlib.sha256()
+
+    def add_entry(path):
+        # tar keeps modes and stores symlinks as links, so both must change the digest
+        mode = os.lstat(path).st_mode
+        digest.update(f"{mode:o}".encode() + b"\0")
+        if stat.S_ISLNK(mode):
+            digest.update(os.readlink(path).encode())
+        elif stat.S_ISREG(mode):
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        digest.update(b"\0")
+
+    add_entry(local_path)
+    if os.path.isdir(local_path) and not os.path.islink(local_path):
+        # os.walk lists symlinked dirs under dirs without descending, so hash them as entries too
+        for root, dirs, files in os.walk(local_path):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, local_path).encode() + b"\0")
+                add_entry(path)
+    return digest.hexdigest()
+
+
+def _artifact_marker(remote_path):
+    return f"{ARTIFACT_MARKER_DIR}/{hashlib.sha256(remote_path.encode()).hexdigest()[:32]}"
+
+
 def copy_artifacts(conn):
     """
     Copy build artifacts from local to remote using compression.
@@ -106,6 +175,7 @@ def copy_artifacts(conn):
     print(f"======= Copying {len(config.COPY_ARTIFACTS)} artifacts =======")
     import tarfile
 
+    pending = []
     for local_path, remote_path in config.COPY_ARTIFACTS:
         # Resolve remote path
         if not remote_path.startswith("/"):
@@ -116,38 +186,84 @@ def copy_artifacts(conn):
             print(f"⚠️ Warning: Local artifact '{local_path}' not found, skipping.")
             continue
 
-        print(f"📦 Processing: {local_path} -> {remote_path}")
+        pending.append((local_path, remote_path, _artifact_digest(local_path)))
 
-        # Create a temporary tarball
-        with tempfile.NamedTemporaryFile(suffix=".tar.gz", delete=False) as tmp_tar:
-            tmp_tar_path = tmp_tar.name
+    if not pending:
+        print("======= Artifacts copied =======")
+        return
 
-        try:
-            # Compress
-            with tarfile.open(tmp_tar_path, "w:gz") as tar:
-                arcname = os.path.basename(remote_path)
-                tar.add(local_path, arcname=arcname)
+    # One round trip reads the digest recorded for every target that still exists. Each
+    # line is tagged with the artifact's index, so a missing or malformed record can't
+    # shift the digests of the artifacts after it
+    check = conn.run(
+        "; ".join(
+            f'if [ -e "{remote_path}" ] && [ -f "{_artifact_marker(remote_path)}" ]; '
+            f'then printf \'{index} %s\\n\' "$(head -n1 "{_artifact_marker(remote_path)}")"; fi'
+            for index, (_, remote_path, _) in enumerate(pending)
+        ),
+        hide=True,
+        warn=True,
+    )
+    remote_digests = {}
+    for line in check.stdout.splitlines():
+        index, _, digest = line.partition(" ")
+        if index.isdigit():
+            remote_digests[int(index)] = digest.strip()
+
+    sftp = None
+    uploaded = []
+    try:
+        for index, (local_path, remote_path, local_digest) in enumerate(pending):
+            if remote_digests.get(index) == local_digest:
+                print(f"✔️ Unchanged: {local_path} -> {remote_path}, skipping upload.")
+                continue
+
+            print(f"📦 Processing: {local_path} -> {remote_path}")
 
-            # Upload
-            remote_tmp = f"/tmp/{os.path.basename(tmp_tar_path)}"
-            conn.put(tmp_tar_path, remote_tmp)
+            # Create a temporary tarball
+            with tempfile.NamedTemporaryFile(suffix=".tar.gz", delete=False) as tmp_tar:
+                tmp_tar_path = tmp_tar.name
 
-            # Ensure parent of destination exists
-            remote_parent = os.path.dirname(remote_path)
-            # Create parent if needed
-            run_command(conn, f"mkdir -p {remote_parent}")
+            try:
+                # Compress
+                with tarfile.open(tmp_tar_path, "w:gz") as tar:
+                    arcname = os.path.basename(remote_path)
+                    tar.add(local_path, arcname=arcname)
 
-            # Remove existing target to be safe (overwrite)
-            run_command(conn, f"rm -rf {remote_path}")
+                # Upload; the SFTP session is only opened once something actually needs sending
+                if sftp is None:
+                    sftp = open_sftp(conn)
+                remote_tmp = f"/tmp/{os.path.basename(tmp_tar_path)}"
+                sftp.put(tmp_tar_path, remote_tmp)
 
-            run_command(conn, f"tar -xzf {remote_tmp} -C {remote_parent}")
+                # Replace the target and clean up in one remote call
+                remote_parent = os.path.dirname(remote_path)
+                run_command(
+                    conn,
+                    f"mkdir -p {remote_parent} && rm -rf {remote_path} && "
+                    f"tar -xzf {remote_tmp} -C {remote_parent} && rm {remote_tmp}",
+                )
+                uploaded.append((remote_path, local_digest))
 
-            # Cleanup remote tmp
-            run_command(conn, f"rm {remote_tmp}")
+            finally:
+                # Cleanup local tmp
+                if os.path.exists(tmp_tar_path):
+                    os.unlink(tmp_tar_path)
+    finally:
+        if sftp is not None:
+            sftp.close()
 
-        finally:
-            # Cleanup local tmp
-            if os.path.exists(tmp_tar_path):
-                os.unlink(tmp_tar_path)
+    if uploaded:
+        # Digests are recorded as the deploy user (not through sudo) in one call; the record
+        # is best effort and never fails the copy
+        conn.run(
+            f'mkdir -p -m 700 "{ARTIFACT_MARKER_DIR}" && chmod 700 "{ARTIFACT_MARKER_DIR}" && '
+            + " && ".join(
+                f'echo {digest} > "{_artifact_marker(remote_path)}"'
+                for remote_path, digest in uploaded
+            ),
+            hide=True,
+            warn=True,
+        )
 
     print("======= Artifacts copied =======")
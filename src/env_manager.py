@@ -1,117 +1,190 @@
 import base64
+import io
 import json
 import os
 import re
-from typing import Dict, List
+from functools import lru_cache
+from typing import Dict, List, Optional
 
 import yaml
 
+try:
+    import orjson
+except ImportError:  # optional: faster JSON decoding, stdlib json otherwise
+    orjson = None
+
 from src import config
 from src.connection import run_command
 
+# Variables under these prefixes configure generation and are never written to files
+_SKIP_PREFIXES = ("ENV_FILES_",)
+
+# Environment names recognised in ENV_{ENV}_* variables besides the current one
+_KNOWN_ENVIRONMENTS = ("PROD", "STAGING", "DEV", "TEST", "PRODUCTION")
+
+# A YAML mapping needs at least one "key:" followed by whitespace or end of line
+_YAML_KEY_RE = re.compile(r":(?:\s|$)", re.MULTILINE)
+_ENV_LINE_RE = re.compile(r"\s*[A-Za-z_][A-Za-z0-9_]*=")
+# KEY= pairs at the start of the blob or after a delimiter (space, comma, newline)
+_ENV_KEY_RE = re.compile(r"(?:^|[\s,])([A-Z0-9_]+)=")
+_COMMENT_LINE_RE = re.compile(r"^[^\S\n]*#.*(?:\n|$)", re.MULTILINE)
+
+# libyaml-backed loader when available, same results as SafeLoader
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def _looks_like_yaml(content: str) -> bool:
+    """Cheap pre-check so env-shaped blobs (e.g. URL=https://x) never reach the YAML parser"""
+    if not _YAML_KEY_RE.search(content):
+        return False
+    if "=" not in content:
+        return True
+    # Every meaningful line is KEY=VALUE -> it's an env blob, not YAML
+    for line in content.splitlines():
+        stripped = line.strip()
+        if stripped and not stripped.startswith("#") and not _ENV_LINE_RE.match(stripped):
+            return True
+    return False
+
 
 def parse_all_in_one_secret(
     secret_content: str, format_hint: str = "auto", strip_quotes: bool = True
 ) -> Dict[str, str]:
-    """Parse all-in-one secret with multiple format support"""
+    """Parse all-in-one secret with multiple format support
+
+    An explicit format_hint whose shape doesn't match the content returns an empty dict.
+    """
     if not secret_content:
         return {}
 
     secret_content = secret_content.strip()
 
     # Check if the content is a file path (common in Jenkins/CI)
-    if os.path.isfile(secret_content):
+    # Cheap in-process checks first so obvious blobs never hit the filesystem
+    if (
+        "\n" not in secret_content
+        and "=" not in secret_content
+        and ": " not in secret_content
+        and not secret_content.startswith("{")
+        and len(secret_content) < 4096
+        and os.path.isfile(secret_content)
+    ):
         try:
             with open(secret_content, "r") as f:
                 secret_content = f.read().strip()
         except Exception:
             pass  # Fallback to treating as literal string
 
+    # Plain single values (hostnames, flags, bare words) can never parse to a mapping
+    if "=" not in secret_content and ":" not in secret_content and "{" not in secret_content:
+        return {}
+
+    return _parse_secret_content(secret_content, format_hint, strip_quotes)
+
+
+def _load_json(content: str):
+    """json.loads, decoded by orjson first when it is installed"""
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # orjson is stricter (no NaN/Infinity, ints beyond 64 bits); stdlib has the last word
+            pass
+    return json.loads(content)
+
+
+def _load_yaml(content: str):
+    """yaml.safe_load through the libyaml loader when it is available"""
+    return yaml.load(content, Loader=_YAML_LOADER)
+
+
+def _load_mapping(loader, content: str) -> Optional[Dict[str, str]]:
+    """Run a JSON/YAML loader and return a stringified dict, or None if it isn't a mapping"""
+    try:
+        parsed = loader(content)
+    except Exception:
+        return None
+    if isinstance(parsed, dict):
+        return {str(k): str(v) for k, v in parsed.items()}
+    return None
+
+
+def _parse_env_lines(content: str, strip_quotes: bool) -> Dict[str, str]:
+    """Parse KEY=VALUE pairs (newline, space or comma separated) from an env blob"""
+    # Normalise line endings the way splitlines() would for CRLF/CR blobs
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+
+    # Remove comment lines first to clean up the block (no per-line split/strip needed)
+    if "#" in content:
+        content = _COMMENT_LINE_RE.sub("", content)
+
+    env_vars = {}
+    # Regex to find all KEY= pairs.
+    # It looks for valid keys at the start of the string or after a delimiter (space, comma, newline)
+    key_matches = list(_ENV_KEY_RE.finditer(content))
+
+    for i in range(len(key_matches)):
+        key = key_matches[i].group(1)
+        # Value starts after the '='
+        val_start = key_matches[i].end()
+        # Value ends where the next key starts, or at the end of the content
+        val_end = key_matches[i + 1].start() if i + 1 < len(key_matches) else len(content)
+
+        raw_value = content[val_start:val_end].strip()
+
+        # Post-process the value:
+        # 1. Strip trailing delimiters (commas/spaces)
+        # 2. Handle quoting: only if strip_quotes is True
+        value = raw_value.rstrip(" ,")
+
+        if strip_quotes and value.startswith(('"', "'")) and value.endswith(value[0]):
+            # Strip outside quotes but keep internal content (including newlines/escapes)
+            value = value[1:-1]
+
+        env_vars[key] = value
+
+    return env_vars
+
+
+def _parse_secret_content(
+    secret_content: str, format_hint: str, strip_quotes: bool
+) -> Dict[str, str]:
+    """Parse already-resolved secret content (JSON, YAML or KEY=VALUE lines)"""
     # Pre-process content to handle escaped newlines for JSON/YAML
     processed_content = secret_content.replace("\\n", "\n")
+    parsed = None
 
     if format_hint == "auto":
         # Check if it's a JSON blob
         if processed_content.startswith("{") and processed_content.endswith("}"):
-            try:
-                parsed = json.loads(processed_content)
-                if isinstance(parsed, dict):
-                    return {str(k): str(v) for k, v in parsed.items()}
-            except Exception:
-                pass
+            parsed = _load_mapping(_load_json, processed_content)
 
         # Check if it looks like YAML (contains keys with colons)
-        if ":" in processed_content:
-            try:
-                parsed = yaml.safe_load(processed_content)
-                # Only return if it's a dict with more than one item or looks like a mapping
-                if isinstance(parsed, dict) and (
-                    len(parsed) > 1 or any(":" in line for line in processed_content.splitlines())
-                ):
-                    return {str(k): str(v) for k, v in parsed.items()}
-            except Exception:
-                pass
+        if parsed is None and _looks_like_yaml(processed_content):
+            parsed = _load_mapping(_load_yaml, processed_content)
+
+        if parsed is not None:
+            return parsed
 
         # Default to ENV if it has equals sign
         if "=" in secret_content:
             format_hint = "env"
 
-    if format_hint == "json":
-        try:
-            parsed = json.loads(processed_content)
-            if isinstance(parsed, dict):
-                return {str(k): str(v) for k, v in parsed.items()}
-        except Exception:
-            pass
+    if format_hint == "json" and processed_content.startswith("{"):
+        parsed = _load_mapping(_load_json, processed_content)
 
-    if format_hint == "yaml":
-        try:
-            parsed = yaml.safe_load(processed_content)
-            if isinstance(parsed, dict):
-                return {str(k): str(v) for k, v in parsed.items()}
-        except Exception:
-            pass
+    if format_hint == "yaml" and ":" in processed_content:
+        # JSON is a subset of YAML; the JSON parser is far cheaper for JSON-shaped blobs
+        if processed_content.startswith("{"):
+            parsed = _load_mapping(_load_json, processed_content)
+        if parsed is None:
+            parsed = _load_mapping(_load_yaml, processed_content)
 
     if format_hint == "env":
-        # Remove comment lines first to clean up the block
-        lines = secret_content.splitlines()
-        clean_content = "\n".join([line for line in lines if not line.strip().startswith("#")])
-
-        env_vars = {}
-        # Regex to find all KEY= pairs.
-        # It looks for valid keys at the start of the string or after a delimiter (space, comma, newline)
-        key_matches = list(re.finditer(r"(?:^|[\s,])([A-Z0-9_]+)=", clean_content))
-
-        if not key_matches:
-            # If no KEY= patterns found, return empty
-            return {}
-
-        for i in range(len(key_matches)):
-            key = key_matches[i].group(1)
-            # Value starts after the '='
-            val_start = key_matches[i].end()
-            # Value ends where the next key starts, or at the end of the content
-            val_end = key_matches[i + 1].start() if i + 1 < len(key_matches) else len(clean_content)
-
-            raw_value = clean_content[val_start:val_end].strip()
-
-            # Post-process the value:
-            # 1. Strip trailing delimiters (commas/spaces)
-            # 2. Handle quoting: only if strip_quotes is True
-            value = raw_value.rstrip(" ,")
-
-            if strip_quotes and (
-                (value.startswith('"') and value.endswith('"'))
-                or (value.startswith("'") and value.endswith("'"))
-            ):
-                # Strip outside quotes but keep internal content (including newlines/escapes)
-                value = value[1:-1]
-
-            env_vars[key] = value
-
-        return env_vars
+        return _parse_env_lines(secret_content, strip_quotes)
 
-    return {}
+    return parsed or {}
 
 
 def merge_raw_env(base_content: str, overrides: Dict[str, str]) -> str:
@@ -131,8 +204,9 @@ def merge_raw_env(base_content: str, overrides: Dict[str, str]) -> str:
             continue
 
         # Look for KEY=VALUE
-        if "=" in stripped:
-            key = stripped.split("=", 1)[0].strip()
+        key, sep, _ = stripped.partition("=")
+        if sep:
+            key = key.rstrip()
             if key in overrides:
                 # Replace the line with the override
                 result_lines.append(f"{key}={overrides[key]}")
@@ -159,26 +233,36 @@ def detect_file_patterns(
     """Auto-detect file patterns from variable names"""
     if structure == "single":
         return [".env"]
+    # Only the names matter, so hosts deploying the same variables share one detection.
+    # Copy so callers can't mutate the cached result
+    return list(_detect_patterns(frozenset(all_env_vars), environment))
 
+
+@lru_cache(maxsize=32)
+def _detect_patterns(var_names: frozenset, environment: str) -> tuple:
+    """File patterns for a set of variable names (memoized)"""
     patterns = set()
     env_upper = (environment or "").upper()
 
-    for var_name in all_env_vars.keys():
-        if var_name.startswith("ENV_FILES_"):
+    # Dynamic check for current environment + common fallbacks, built once per call
+    env_candidates = [
+        (env, f"ENV_{env}_", f"ENV_{env}") for env in {env_upper, *_KNOWN_ENVIRONMENTS} if env
+    ]
+
+    for var_name in var_names:
+        if var_name.startswith(_SKIP_PREFIXES):
             continue
 
-        # Determine if it's environment-specific
+        # Determine if it's environment-specific, extracting the component suffix as we go
         matched_env = ""
-        # Dynamic check for current environment + common fallbacks
-        env_candidates = list(set([env_upper, "PROD", "STAGING", "DEV", "TEST", "PRODUCTION"]))
-        for env in env_candidates:
-            if not env:
-                continue
-            if var_name.startswith(f"ENV_{env}_"):
+        suffix = ""
+        for env, env_prefix, env_key in env_candidates:
+            if var_name.startswith(env_prefix):
                 matched_env = env
+                suffix = var_name[len(env_prefix) :]
                 break
             # Handle exact match like ENV_PROD_APP (blob)
-            if var_name == f"ENV_{env}":
+            if var_name == env_key:
                 matched_env = env
                 break
 
@@ -186,54 +270,46 @@ def detect_file_patterns(
         if matched_env and matched_env != env_upper:
             continue
 
-        # Extract component name
-        suffix = ""
-        if matched_env:
-            # Strip ENV_{ENV}_ or ENV_{ENV}
-            for prefix in [f"ENV_{matched_env}_", f"ENV_{matched_env}"]:
-                if var_name.startswith(prefix):
-                    suffix = var_name[len(prefix) :]
-                    break
-        elif var_name.startswith("ENV_"):
-            # Strip ENV_
-            suffix = var_name[4:]
-        else:
-            # This is a direct variable (no prefix) from a blob, it goes to the primary .env
-            continue
-
-        # Clean up leading underscores if any (e.g. _REDIS)
-        suffix = suffix.lstrip("_")
+        if not matched_env:
+            if var_name.startswith("ENV_"):
+                # Strip ENV_
+                suffix = var_name[4:]
+            else:
+                # This is a direct variable (no prefix) from a blob, it goes to the primary .env
+                continue
 
-        if suffix:
-            filename = suffix.split("_")[0].lower()
-            if filename:
-                patterns.add(f".env.{filename}")
-        else:
-            pass
+        # Component name is the first token, ignoring leading underscores (e.g. _REDIS)
+        filename = suffix.lstrip("_").partition("_")[0].lower()
+        if filename:
+            patterns.add(f".env.{filename}")
 
-    return sorted(list(patterns)) or [".env.app"]
+    return tuple(sorted(patterns)) or (".env.app",)
 
 
 def determine_file_structure(
-    structure: str, patterns: List[str], environment: str, base_path: str
+    structure: str,
+    patterns: List[str],
+    environment: str,
+    base_path: str,
+    env_vars: Optional[Dict[str, str]] = None,
 ) -> Dict[str, str]:
-    """Determine file paths based on structure preference"""
+    """Determine file paths based on structure preference
+
+    env_vars is the already-collected ENV/ENV_* snapshot; os.environ is scanned when omitted.
+    """
     file_paths = {}
 
     if structure == "auto":
         # Heuristic: multiple patterns or presence of env-specific vars -> nested
-        has_env_specific = False
-        if environment:
-            env_upper = environment.upper()
-            for var_name in os.environ:
-                if var_name.startswith(f"ENV_{env_upper}_"):
-                    has_env_specific = True
-                    break
-
-        if len(patterns) > 1 or has_env_specific:
+        # (the variable scan only runs when the pattern count alone doesn't decide it)
+        structure = "flat"
+        if len(patterns) > 1:
             structure = "nested"
-        else:
-            structure = "flat"
+        elif environment:
+            env_prefix = f"ENV_{environment.upper()}_"
+            names = os.environ if env_vars is None else env_vars
+            if any(var_name.startswith(env_prefix) for var_name in names):
+                structure = "nested"
 
     dir_base = base_path
     use_default_envs = True
@@ -263,60 +339,73 @@ def determine_file_structure(
 
 
 def merge_env_vars_by_priority(
-    all_env_vars: Dict[str, str], environment: str, pattern: str
+    all_env_vars: Dict[str, str],
+    environment: str,
+    pattern: str,
+    blob_cache: Optional[Dict[str, Dict[str, str]]] = None,
 ) -> Dict[str, str]:
-    """Merge environment variables with proper priority"""
+    """Merge environment variables with proper priority
+
+    blob_cache (raw value -> parsed dict) can be shared across calls so each blob is
+    parsed once per run rather than once per pattern.
+    """
     merged = {}
     env_upper = (environment or "").upper()
+    fmt = config.ENV_FILES_FORMAT
+    if blob_cache is None:
+        blob_cache = {}
+
+    def parse_blob(value: str) -> Dict[str, str]:
+        if value not in blob_cache:
+            blob_cache[value] = parse_all_in_one_secret(value, fmt)
+        return blob_cache[value]
 
     # 1. Handle Global File (.env) - Retain Component Prefixes to avoid collisions
     if pattern == ".env":
-        # Base variables (ENV_X)
-        for k, v in all_env_vars.items():
-            if k.startswith("ENV_"):
-                # Skip internal configuration and raw blobs
-                if k.startswith("ENV_FILES_") or k == "ENV":
-                    continue
-
-                # Skip environment-specific ones
-                env_candidates = [env_upper, "PROD", "STAGING", "DEV", "TEST", "PRODUCTION"]
-                if any(k.startswith(f"ENV_{e}_") for e in env_candidates if e):
-                    continue
-
-                key = k[4:]  # e.g. APP or APP_PORT
-                parsed = parse_all_in_one_secret(v, config.ENV_FILES_FORMAT)
-                if parsed:
-                    # If it's a component-level blob (e.g. ENV_APP), prefix its contents
-                    # e.g. ENV_APP -> BASE_URL becomes APP_BASE_URL
-                    # Unless it's already an individual var (key has underscore)
-                    if "_" in key:
-                        merged[key] = v
-                    else:
-                        for pk, pv in parsed.items():
-                            p_key = pk if pk.startswith(f"{key.upper()}_") else f"{key}_{pk}"
-                            merged[p_key] = pv
-                else:
-                    merged[key] = v
-
-        # Environment-specific overrides (ENV_PROD_X)
-        prefix = f"ENV_{env_upper}_"
+        # Internal configuration and environment-specific variables never count as base ones
+        base_skip_prefixes = _SKIP_PREFIXES + tuple(
+            f"ENV_{e}_" for e in {env_upper, *_KNOWN_ENVIRONMENTS} if e
+        )
+
+        env_prefix = f"ENV_{env_upper}_"
+
+        # Single pass bucketing base variables (ENV_X) and env-specific overrides (ENV_PROD_X)
+        base_items = []
+        env_items = []
         for k, v in all_env_vars.items():
-            if k.startswith(prefix):
-                key = k[len(prefix) :]
-                parsed = parse_all_in_one_secret(v, config.ENV_FILES_FORMAT)
-                if parsed:
-                    if "_" in key:
-                        merged[key] = v
-                    else:
-                        for pk, pv in parsed.items():
-                            p_key = pk if pk.startswith(f"{key.upper()}_") else f"{key}_{pk}"
-                            merged[p_key] = pv
-                else:
-                    merged[key] = v
+            if not k.startswith("ENV_"):
+                continue
+            if k.startswith(env_prefix):
+                env_items.append((k[len(env_prefix) :], v))
+            if not k.startswith(base_skip_prefixes):
+                base_items.append((k[4:], v))  # e.g. APP or APP_PORT
+
+        # Overrides are applied after the base variables so they win
+        for key, v in base_items + env_items:
+            # Individual vars (key has underscore, e.g. APP_PORT) are kept verbatim, never parsed
+            if "_" in key:
+                merged[key] = v
+                continue
+            parsed = parse_blob(v)
+            if parsed:
+                # If it's a component-level blob (e.g. ENV_APP), prefix its contents
+                # e.g. ENV_APP -> BASE_URL becomes APP_BASE_URL
+                key_prefix = f"{key.upper()}_"
+                key_join = key + "_"
+                merged.update(
+                    {
+                        (pk if pk.startswith(key_prefix) else key_join + pk): pv
+                        for pk, pv in parsed.items()
+                    }
+                )
+            else:
+                merged[key] = v
         return merged
 
     # 2. Handle Patterned Files (.env.component) - Clean keys
     file_base = pattern.replace(".env.", "").upper()
+    comp_prefix = f"{file_base}_"
+    comp_prefix_len = len(comp_prefix)
 
     # Priority stages:
     # A. Base Individual (ENV_APP_PORT)
@@ -324,73 +413,125 @@ def merge_env_vars_by_priority(
     # C. Env Individual (ENV_PROD_APP_PORT)
     # D. Env Blob (ENV_PROD_APP)
 
-    # A. Prefix search (e.g. ENV_APP_...)
     base_prefix = f"ENV_{file_base}_"
+    env_prefix = f"ENV_{env_upper}_{file_base}_"
+
+    # One pass collects both individual-variable families (A and C)
+    env_individual = {}
     for k, v in all_env_vars.items():
         if k.startswith(base_prefix):
-            key = k[len(base_prefix) :]
-            merged[key] = v
+            merged[k[len(base_prefix) :]] = v
+        if k.startswith(env_prefix):
+            env_individual[k[len(env_prefix) :]] = v
 
-    # B. Component Blob (e.g. ENV_APP)
-    base_blob_key = f"ENV_{file_base}"
-    if base_blob_key in all_env_vars:
-        parsed = parse_all_in_one_secret(all_env_vars[base_blob_key], config.ENV_FILES_FORMAT)
+    # A. Prefix search (e.g. ENV_APP_...) was applied directly above
+
+    def apply_blob(blob_key: str) -> None:
+        if blob_key not in all_env_vars:
+            return
+        raw = all_env_vars[blob_key]
+        parsed = parse_blob(raw)
         if parsed:
             # Strip component prefix if present to stay consistent with A/C
-            for pk, pv in parsed.items():
-                p_key = pk[len(f"{file_base}_") :] if pk.startswith(f"{file_base}_") else pk
-                merged[p_key] = pv
-        elif all_env_vars[base_blob_key].strip():
-            merged[file_base] = all_env_vars[base_blob_key]
+            merged.update(
+                {
+                    (pk[comp_prefix_len:] if pk.startswith(comp_prefix) else pk): pv
+                    for pk, pv in parsed.items()
+                }
+            )
+        elif raw.strip():
+            merged[file_base] = raw
+
+    # B. Component Blob (e.g. ENV_APP)
+    apply_blob(f"ENV_{file_base}")
 
     # C. Env Specific Individual (e.g. ENV_PROD_APP_...)
-    env_prefix = f"ENV_{env_upper}_{file_base}_"
-    for k, v in all_env_vars.items():
-        if k.startswith(env_prefix):
-            key = k[len(env_prefix) :]
-            merged[key] = v
+    merged.update(env_individual)
 
     # D. Env Specific Blob (e.g. ENV_PROD_APP)
-    comp_env_key = f"ENV_{env_upper}_{file_base}"
-    if comp_env_key in all_env_vars:
-        parsed = parse_all_in_one_secret(all_env_vars[comp_env_key], config.ENV_FILES_FORMAT)
-        if parsed:
-            for pk, pv in parsed.items():
-                p_key = pk[len(f"{file_base}_") :] if pk.startswith(f"{file_base}_") else pk
-                merged[p_key] = pv
-        elif all_env_vars[comp_env_key].strip():
-            merged[file_base] = all_env_vars[comp_env_key]
+    apply_blob(f"ENV_{env_upper}_{file_base}")
 
     return merged
 
 
-def detect_environment_secrets() -> Dict[str, str]:
-    """Auto-detect secrets and return raw file content mapped by pattern"""
+def collect_env_vars(environ=None) -> Dict[str, str]:
+    """Snapshot the ENV template and ENV_* secrets (minus ENV_FILES_* config) in one pass"""
+    environ = os.environ if environ is None else environ
+    env_vars = {
+        k: v
+        for k, v in environ.items()
+        if k.startswith("ENV_") and not k.startswith(_SKIP_PREFIXES)
+    }
+    # The bare ENV template is a single lookup rather than an extra test on every variable
+    if "ENV" in environ:
+        env_vars["ENV"] = environ["ENV"]
+    return env_vars
+
+
+def _bucket_by_component(env_vars: Dict[str, str], environment: str) -> Dict[str, Dict[str, str]]:
+    """Group ENV_* variables by the first token of their component, in one pass
+
+    ENV_APP_PORT and ENV_{ENV}_APP_PORT both land under "APP". A name is filed under
+    both readings when the part after ENV_ starts with the environment name; buckets
+    keep the original variable order.
+    """
+    env_prefix = f"{(environment or '').upper()}_"
+    buckets = {}
+    for k, v in env_vars.items():
+        if not k.startswith("ENV_"):
+            continue
+        rest = k[4:]
+        buckets.setdefault(rest.partition("_")[0], {})[k] = v
+        if rest.startswith(env_prefix):
+            buckets.setdefault(rest[len(env_prefix) :].partition("_")[0], {})[k] = v
+    return buckets
+
+
+def detect_environment_secrets(
+    env_vars: Optional[Dict[str, str]] = None,
+    blob_cache: Optional[Dict[str, Dict[str, str]]] = None,
+) -> Dict[str, str]:
+    """Auto-detect secrets and return raw file content mapped by pattern
+
+    env_vars is a collect_env_vars() snapshot; os.environ is collected when omitted.
+    """
+    if env_vars is None:
+        env_vars = collect_env_vars()
+    if blob_cache is None:
+        blob_cache = {}
+
     # 1. Get Base Template (ENV)
-    base_template = os.environ.get("ENV") or ""
+    base_template = env_vars.get("ENV") or ""
 
     # 2. Collect Overrides (ENV_...)
     # We group variables by their intended file pattern
-    raw_overrides = {}
-    for k, v in os.environ.items():
-        if k.startswith("ENV_") and not k.startswith("ENV_FILES_"):
-            raw_overrides[k] = v
+    raw_overrides = {k: v for k, v in env_vars.items() if k != "ENV"}
 
     structure = config.ENV_FILES_STRUCTURE
+    environment = config.ENVIRONMENT
+    explicit_patterns = config.ENV_FILES_PATTERNS
     if structure == "single":
         patterns = [".env"]
+    elif explicit_patterns and structure != "auto":
+        patterns = [p.strip() for p in explicit_patterns if p.strip()]
     else:
-        patterns = detect_file_patterns(raw_overrides, structure, config.ENVIRONMENT)
-        if config.ENV_FILES_PATTERNS and structure != "auto":
-            patterns = [p.strip() for p in config.ENV_FILES_PATTERNS if p.strip()]
+        patterns = detect_file_patterns(raw_overrides, structure, environment)
 
     result = {}
+    # Component files only ever read their own ENV_{COMP}* / ENV_{ENV}_{COMP}* variables,
+    # so each pattern merges its bucket instead of rescanning every variable
+    buckets = _bucket_by_component(raw_overrides, environment)
 
     for pattern in patterns:
         # Merge individual vars for this pattern
         # Note: merge_env_vars_by_priority already handles prefixes and blobs
         # and returns a final flattened dict of KEY:VALUE
-        overrides = merge_env_vars_by_priority(raw_overrides, config.ENVIRONMENT, pattern)
+        if pattern == ".env":
+            pattern_vars = raw_overrides
+        else:
+            component = pattern.replace(".env.", "").upper().partition("_")[0]
+            pattern_vars = buckets.get(component, {})
+        overrides = merge_env_vars_by_priority(pattern_vars, environment, pattern, blob_cache)
 
         if pattern == ".env":
             # For the main .env, we use the base template
@@ -416,16 +557,39 @@ def create_env_file(conn, file_path: str, env_content: str) -> None:
     if not env_content:
         return
     dir_path = os.path.dirname(file_path)
-    # Use base64 to avoid shell character/newline mangling issues
-    encoded = base64.b64encode(env_content.encode("utf-8")).decode("utf-8")
 
-    # Batch commands into one SSH round-trip and skip expensive shell profile sourcing
+    # One SSH round-trip, content streamed over stdin so it never touches the command line.
+    # The umask keeps the file private from creation; chmod covers pre-existing files.
     batch_cmd = (
         f'mkdir -p "{dir_path}" && '
-        f'echo "{encoded}" | base64 -d | tee "{file_path}" > /dev/null && '
+        f'(umask 177 && cat > "{file_path}") && '
         f'chmod 600 "{file_path}"'
     )
-    run_command(conn, batch_cmd, use_shell_profile=False)
+    run_command(conn, batch_cmd, use_shell_profile=False, in_stream=io.StringIO(env_content))
+
+
+def create_env_files(conn, files: Dict[str, str]) -> None:
+    """Create several .env files (path -> content) in a single remote shell invocation"""
+    files = {path: content for path, content in files.items() if content}
+    if not files:
+        return
+
+    # Each file body is base64 inside a quoted heredoc: no shell mangling and the
+    # delimiter can never collide with the payload. The script itself goes over stdin.
+    # set -e ignores failures inside an && list, so each list exits explicitly on failure
+    script_lines = ["set -e"]
+    for file_path, env_content in files.items():
+        encoded = base64.b64encode(env_content.encode("utf-8")).decode("ascii")
+        script_lines.append(
+            f'mkdir -p "{os.path.dirname(file_path)}" && '
+            f"(umask 177 && base64 -d > \"{file_path}\") <<'METALDEPLOY_EOF' && "
+            f'chmod 600 "{file_path}" || exit 1'
+        )
+        script_lines.append(encoded)
+        script_lines.append("METALDEPLOY_EOF")
+    script = "\n".join(script_lines) + "\n"
+
+    run_command(conn, "bash -s", use_shell_profile=False, in_stream=io.StringIO(script))
 
 
 def generate_env_files(conn) -> None:
@@ -435,12 +599,10 @@ def generate_env_files(conn) -> None:
 
     print("🔧 Generating environment files from secrets...")
     try:
-        all_env_vars = {
-            k: v
-            for k, v in os.environ.items()
-            if (k.startswith("ENV_") or k == "ENV") and not k.startswith("ENV_FILES_")
-        }
-        env_file_data = detect_environment_secrets()
+        # Single snapshot of the environment shared by every stage below
+        all_env_vars = collect_env_vars()
+        blob_cache = {}
+        env_file_data = detect_environment_secrets(all_env_vars, blob_cache)
         if not env_file_data:
             print("ℹ\ufe0f  No environment variables found to generate files")
             return
@@ -451,24 +613,31 @@ def generate_env_files(conn) -> None:
             list(env_file_data.keys()),
             config.ENVIRONMENT,
             config.GIT_SUBDIR,
+            all_env_vars,
         )
 
+        # Collect every file first and write them all in one remote round-trip
+        files_to_write = {}
         for pattern, env_content in env_file_data.items():
             file_path = file_paths.get(pattern)
             if file_path:
                 print(f"📝 Creating {file_path} (formatted content preserved)")
-                create_env_file(conn, file_path, env_content)
+                files_to_write[file_path] = env_content
 
         if config.ENV_FILES_CREATE_ROOT:
             # Generate the root file as if it were 'single' structure to ensure consistent prefixing
-            root_vars = merge_env_vars_by_priority(all_env_vars, config.ENVIRONMENT, ".env")
+            root_vars = merge_env_vars_by_priority(
+                all_env_vars, config.ENVIRONMENT, ".env", blob_cache
+            )
             root_env_path = os.path.join(config.GIT_SUBDIR, ".env")
             if root_vars:
                 # For root mega-file, we also try to use the ENV template
-                base_template = os.environ.get("ENV") or ""
+                base_template = all_env_vars.get("ENV") or ""
                 root_content = merge_raw_env(base_template, root_vars)
                 print(f"📝 Creating combined root {root_env_path}")
-                create_env_file(conn, root_env_path, root_content)
+                files_to_write[root_env_path] = root_content
+
+        create_env_files(conn, files_to_write)
 
         print("✅ Environment files generated successfully")
 
@@ -1,12 +1,13 @@
 import base64
-import os
-import tempfile
-
-from invoke import Responder
+import io
 
 from src import config
 from src.connection import run_command
 
+# Exit statuses of the clone_repo target probe (0 means an existing git checkout)
+GIT_DIR_NOT_REPO = 10
+GIT_DIR_MISSING = 11
+
 
 def setup_git_auth():
     """Setup Git authentication based on GIT_AUTH_METHOD"""
@@ -36,10 +37,8 @@ def setup_git_auth():
         except Exception:
             key_content = git_ssh_key
 
-        with tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".pem") as f:
-            f.write(key_content)
-            config.GIT_SSH_KEY_PATH = f.name
-        os.chmod(config.GIT_SSH_KEY_PATH, 0o600)
+        # Kept in memory and streamed to the remote host by clone_repo, never written locally
+        config.GIT_SSH_KEY_CONTENT = key_content
 
         if config.GIT_URL.startswith("https://"):
             url_parts = config.GIT_URL.replace("https://", "").replace("http://", "")
@@ -58,84 +57,101 @@ def setup_git_auth():
         )
 
 
-def clone_repo(conn):
-    """Clone the Git repository to the remote server"""
-    promptpass = Responder(
-        pattern=r"Are you sure you want to continue connecting " r"\(yes/no/\[fingerprint\]\)\?",
-        response="yes\n",
-    )
+def _git_ssh_prefix():
+    """Environment prefix that keeps git's ssh from ever prompting for a host key"""
+    if config.GIT_AUTH_METHOD == "ssh":
+        return "GIT_SSH_COMMAND='ssh -i /tmp/git_deploy_key -o StrictHostKeyChecking=no' "
+    if config.AUTH_GIT_URL and not config.AUTH_GIT_URL.startswith(("https://", "http://")):
+        return "GIT_SSH_COMMAND='ssh -o StrictHostKeyChecking=accept-new' "
+    return ""
 
-    conn.run(f"mkdir -p {config.REMOTE_DIR}", warn=True)
 
-    if config.GIT_AUTH_METHOD == "ssh" and config.GIT_SSH_KEY_PATH:
-        conn.put(config.GIT_SSH_KEY_PATH, "/tmp/git_deploy_key")
-        conn.run("chmod 600 /tmp/git_deploy_key")
+def clone_repo(conn):
+    """Clone the Git repository to the remote server"""
+    # Host keys are accepted non-interactively, so git runs without a pty and streams packs raw
+    git_env = _git_ssh_prefix()
 
+    if config.GIT_AUTH_METHOD == "ssh" and config.GIT_SSH_KEY_CONTENT:
         ssh_config = """
 Host github.com
     IdentityFile /tmp/git_deploy_key
     StrictHostKeyChecking no
     UserKnownHostsFile /dev/null
 """
-        conn.run("mkdir -p ~/.ssh", warn=True)
-        conn.run(f'echo "{ssh_config}" >> ~/.ssh/config')
-        conn.run("chmod 600 ~/.ssh/config")
+        # The key arrives over stdin and is created 0600, so no SFTP upload or chmod is needed.
+        # The host entry is only appended once, so ~/.ssh/config doesn't grow every deploy
+        conn.run(
+            "(umask 177 && cat > /tmp/git_deploy_key) && mkdir -p ~/.ssh && "
+            "{ grep -qxF '    IdentityFile /tmp/git_deploy_key' ~/.ssh/config 2>/dev/null || "
+            f'echo "{ssh_config}" >> ~/.ssh/config; }} && chmod 600 ~/.ssh/config',
+            in_stream=io.StringIO(config.GIT_SSH_KEY_CONTENT),
+        )
 
+    # Create the parent dir and classify the target in a single round trip; the exit
+    # status carries the answer so nothing has to be echoed and scanned
     result = conn.run(
-        f'test -d {config.GIT_DIR} && echo "exists" || echo "not exists"',
+        f"mkdir -p {config.REMOTE_DIR}; "
+        f"if [ -d {config.GIT_DIR}/.git ]; then exit 0; "
+        f"elif [ -d {config.GIT_DIR} ]; then exit {GIT_DIR_NOT_REPO}; "
+        f"else exit {GIT_DIR_MISSING}; fi",
         hide=True,
+        warn=True,
     )
 
-    if "not exists" in result.stdout:
+    if result.exited == GIT_DIR_MISSING:
         print("======= Cloning the repository =======")
+        # Deployments only need branch tips: shallow keeps the transfer small while
+        # --no-single-branch still lets any environment branch be checked out below.
+        # No blob filter: a partial clone fetches blobs lazily on switch/checkout, which run
+        # without the deploy key's GIT_SSH_COMMAND
+        # -c persists protocol v2 in the new repo, so later fetches also skip the full ref advertisement
+        clone_opts = "--depth=1 --no-single-branch -c protocol.version=2"
         with conn.cd(config.REMOTE_DIR):
-            if config.GIT_AUTH_METHOD == "ssh":
-                conn.run(
-                    f"GIT_SSH_COMMAND='ssh -i /tmp/git_deploy_key -o StrictHostKeyChecking=no' git clone {config.AUTH_GIT_URL} {config.PROJECT_NAME}",
-                    pty=True,
-                    watchers=[promptpass],
-                )
-            else:
-                conn.run(
-                    f"git clone {config.AUTH_GIT_URL} {config.PROJECT_NAME}",
-                    pty=True,
-                    watchers=[promptpass],
-                )
+            conn.run(f"{git_env}git clone {clone_opts} {config.AUTH_GIT_URL} {config.PROJECT_NAME}")
+    elif result.exited == GIT_DIR_NOT_REPO:
+        print(f"======= Directory {config.GIT_DIR} exists but is not a git repository =======")
+        with conn.cd(config.GIT_DIR):
+            conn.run("git init", warn=False)
+            conn.run(
+                f"git remote add origin {config.AUTH_GIT_URL} && git config protocol.version 2",
+                warn=False,
+            )
+            conn.run(f"{git_env}git fetch --depth=1 origin")
+            conn.run(
+                "git branch -M main 2>/dev/null || git branch -M master 2>/dev/null || true",
+                warn=False,
+            )
+            conn.run(
+                "git checkout -b main origin/main 2>/dev/null || git checkout -b master origin/master 2>/dev/null || true",
+                warn=False,
+            )
+    elif result.exited == 0:
+        print(f"======= Repository already exists at {config.GIT_DIR}, skipping clone =======")
     else:
-        git_check = conn.run(
-            f'test -d {config.GIT_DIR}/.git && echo "git_repo" || echo "not_git_repo"',
-            hide=True,
+        # e.g. mkdir failing on permissions or the shell dying; never mistake it for a repo
+        raise RuntimeError(
+            f"Could not inspect {config.GIT_DIR} (exit {result.exited}): {result.stderr.strip()}"
         )
-        if "not_git_repo" in git_check.stdout:
-            print(f"======= Directory {config.GIT_DIR} exists but is not a git repository =======")
-            with conn.cd(config.GIT_DIR):
-                conn.run("git init", warn=False)
-                conn.run(f"git remote add origin {config.AUTH_GIT_URL}", warn=False)
-                if config.GIT_AUTH_METHOD == "ssh":
-                    conn.run(
-                        "GIT_SSH_COMMAND='ssh -i /tmp/git_deploy_key -o StrictHostKeyChecking=no' git fetch origin",
-                        pty=True,
-                        watchers=[promptpass],
-                    )
-                else:
-                    conn.run("git fetch origin", pty=True, watchers=[promptpass])
-                conn.run(
-                    "git branch -M main 2>/dev/null || git branch -M master 2>/dev/null || true",
-                    warn=False,
-                )
-                conn.run(
-                    "git checkout -b main origin/main 2>/dev/null || git checkout -b master origin/master 2>/dev/null || true",
-                    warn=False,
-                )
-        else:
-            print(f"======= Repository already exists at {config.GIT_DIR}, skipping clone =======")
 
-    conn.run(f"git config --global --add safe.directory {config.GIT_DIR}")
-    run_command(conn, f"chown -R $(whoami) {config.GIT_DIR}", force_sudo=True)
+    # Only re-own entries that aren't already ours instead of rewriting every inode each deploy.
+    # The user is passed explicitly: $(whoami) would expand to root inside the sudo wrapper
+    run_command(
+        conn,
+        f"find {config.GIT_DIR} ! -user {config.REMOTE_USER} -exec chown -h {config.REMOTE_USER} {{}} +",
+        force_sudo=True,
+    )
 
     with conn.cd(config.GIT_SUBDIR):
+        # Repo setup rides along with the first git command below instead of its own round trip
+        # safe.directory is only appended once, so the global config doesn't grow every deploy
+        prelude = (
+            f"{{ git config --global --get-all safe.directory | grep -qxF {config.GIT_DIR} || "
+            f"git config --global --add safe.directory {config.GIT_DIR}; }} && "
+            "git config protocol.version 2 && "
+        )
         if config.ENVIRONMENT in ["prod", "production"]:
-            result = conn.run("git branch -r", hide=True)
+            result = conn.run(f"{prelude}git branch -r", hide=True)
+            prelude = ""
             remote_branches = [line.strip() for line in result.stdout.strip().splitlines()]
 
             if "origin/main" in remote_branches:
@@ -147,17 +163,13 @@ Host github.com
         else:
             branch_name = config.ENVIRONMENT
 
-        current_branch = conn.run("git rev-parse --abbrev-ref HEAD", hide=True).stdout.strip()
-
-        if current_branch != branch_name:
-            conn.run("git stash", warn=True)
-            conn.run(f"git checkout {branch_name}")
-
-        if config.GIT_AUTH_METHOD == "ssh":
-            conn.run(
-                f"GIT_SSH_COMMAND='ssh -i /tmp/git_deploy_key -o StrictHostKeyChecking=no' git fetch origin && git reset --hard origin/{branch_name}"
-            )
-        else:
-            conn.run(f"git fetch origin && git reset --hard origin/{branch_name}")
+        # The deploy tree is disposable: switch straight to the fetched tip, dropping local edits,
+        # rather than stash + checkout + reset --hard (unchanged files are left untouched).
+        # switch also gets the SSH command: checkouts made as partial clones by earlier
+        # versions still fetch missing blobs from the remote on switch
+        conn.run(
+            f"{prelude}{git_env}git fetch origin {branch_name} && "
+            f"{git_env}git switch --discard-changes -C {branch_name} FETCH_HEAD"
+        )
 
     print(f"=== Repository cloned & checked out to {branch_name} branch =======")
@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import time
+
+from src import config
+
+# How long a recorded install is trusted before the host is probed again
+INSTALL_STATE_TTL = 86400
+
+
+def _connect():
+    os.makedirs(os.path.dirname(os.path.abspath(config.HOST_STATE_CACHE)), exist_ok=True)
+    db = sqlite3.connect(config.HOST_STATE_CACHE, timeout=5)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS host_tools ("
+        "host TEXT NOT NULL, tool TEXT NOT NULL, installed_at REAL NOT NULL, "
+        "PRIMARY KEY (host, tool))"
+    )
+    return db
+
+
+def get_installed(host, tools, ttl=INSTALL_STATE_TTL):
+    """Return the tools recorded as installed on host within ttl seconds (empty if disabled)"""
+    if not config.HOST_STATE_CACHE or not tools:
+        return set()
+    try:
+        db = _connect()
+        try:
+            placeholders = ",".join("?" * len(tools))
+            rows = db.execute(
+                f"SELECT tool FROM host_tools WHERE host = ? AND tool IN ({placeholders}) "
+                "AND installed_at >= ?",
+                (host, *tools, time.time() - ttl),
+            ).fetchall()
+        finally:
+            db.close()
+    except (sqlite3.Error, OSError):
+        return set()
+    return {row[0] for row in rows}
+
+
+def record_installed(host, tools):
+    """Remember that tools are installed on host; cache failures are never fatal"""
+    if not config.HOST_STATE_CACHE or not tools:
+        return
+    now = time.time()
+    try:
+        db = _connect()
+        try:
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO host_tools (host, tool, installed_at) VALUES (?, ?, ?)",
+                    [(host, tool, now) for tool in tools],
+                )
+        finally:
+            db.close()
+    except (sqlite3.Error, OSError):
+        pass
+
+
+def forget_installed(host, tools):
+    """Drop cached install state so the next deploy probes host again"""
+    if not config.HOST_STATE_CACHE or not tools:
+        return
+    try:
+        db = _connect()
+        try:
+            with db:
+                db.executemany(
+                    "DELETE FROM host_tools WHERE host = ? AND tool = ?",
+                    [(host, tool) for tool in tools],
+                )
+        finally:
+            db.close()
+    except (sqlite3.Error, OSError):
+        pass
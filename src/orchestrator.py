@@ -1,11 +1,17 @@
 import concurrent.futures
-import multiprocessing
 import os
 
 from fabric import Connection
-
-from src import config
-from src.connection import copy_artifacts, install_dependencies, run_command, setup_ssh_key
+from invoke.exceptions import UnexpectedExit
+
+from src import config, host_state
+from src.connection import (
+    copy_artifacts,
+    install_dependencies,
+    probe_installed,
+    run_command,
+    setup_ssh_key,
+)
 from src.env_manager import generate_env_files
 from src.git_ops import clone_repo, setup_git_auth
 from src.providers.baremetal import deploy_baremetal
@@ -20,15 +26,12 @@ def deploy(conn):
     if config.DEPLOY_COMMAND:
         with conn.cd(config.GIT_SUBDIR):
             print(f"======= Running deploy command: {config.DEPLOY_COMMAND} =======")
-            result = run_command(
-                conn,
-                f"{config.DEPLOY_COMMAND}; EXIT_CODE=$?; if [ $EXIT_CODE -ne 0 ]; then echo 'Command failed with exit code:' $EXIT_CODE; exit $EXIT_CODE; fi",
-            )
-            if "Command failed with exit code:" in result.stdout:
-                for line in result.stdout.split("\n"):
-                    if "Command failed with exit code:" in line:
-                        exit_code = line.split("exit code:")[-1].strip()
-                        raise ValueError(f"Deploy command failed with exit code: {exit_code}")
+            try:
+                run_command(conn, config.DEPLOY_COMMAND)
+            except UnexpectedExit as e:
+                raise ValueError(
+                    f"Deploy command failed with exit code: {e.result.exited}"
+                ) from None
         print("======= Deploy command completed =======")
         return
 
@@ -66,12 +69,30 @@ def deploy_single_host():
             f.write(f"remote_hostname={hostname}\n")
 
     install_dependencies(conn)
+    installers = {}
     if config.DEPLOYMENT_TYPE in ["docker", "k8s"]:
-        install_docker(conn)
+        installers["docker"] = install_docker
     if config.DEPLOYMENT_TYPE == "k8s":
-        install_kubectl(conn)
-        install_helm(conn)
-        install_k3s(conn)
+        # k3s first: its installer symlinks a bundled kubectl, so install_kubectl then finds it
+        # on the host and skips the separate version lookup and binary download
+        installers.update(k3s=install_k3s, helm=install_helm, kubectl=install_kubectl)
+    tools = list(installers)
+    if tools:
+        # Tools recorded on a recent deploy skip the probe; the rest share one `command -v`
+        cached = host_state.get_installed(config.REMOTE_HOST, tools)
+        unknown = [tool for tool in tools if tool not in cached]
+        installed = cached | probe_installed(conn, unknown) if unknown else cached
+        for tool, installer in installers.items():
+            if tool in installed:
+                print(f"======= {tool} already installed =======")
+                continue
+            try:
+                installer(conn)
+            except Exception:
+                host_state.forget_installed(config.REMOTE_HOST, [tool])
+                raise
+        # Only re-stamp what this run verified, so cached entries still age out after the TTL
+        host_state.record_installed(config.REMOTE_HOST, unknown)
 
     clone_repo(conn)
     if config.ENV_FILES_GENERATE:
@@ -79,31 +100,30 @@ def deploy_single_host():
 
     copy_artifacts(conn)
 
-    deploy(conn)
+    try:
+        deploy(conn)
+    except Exception:
+        # A failing deploy may mean a tool went missing; re-probe next time
+        host_state.forget_installed(config.REMOTE_HOST, tools)
+        raise
 
     if os.getenv("GITHUB_OUTPUT"):
         with open(os.getenv("GITHUB_OUTPUT"), "a") as f:
             f.write("deployment_status=success\n")
 
     # Cleanup
-    for path in [config.SSH_KEY_PATH, config.GIT_SSH_KEY_PATH]:
-        if path and os.path.exists(path):
-            try:
-                os.unlink(path)
-            except OSError:
-                pass
+    if config.SSH_KEY_PATH and os.path.exists(config.SSH_KEY_PATH):
+        try:
+            os.unlink(config.SSH_KEY_PATH)
+        except OSError:
+            pass
 
 
 def deploy_worker(overrides):
-    """Worker entry point for multiprocessing"""
-    try:
-        # Reload config with this worker's specific overrides
-        config.load(overrides)
+    """Worker entry point for multi-host deploys (runs in a thread)"""
+    # Each worker thread gets its own config so hosts don't clobber each other's settings
+    with config.bind(overrides):
         deploy_single_host()
-    except Exception as e:
-        # Ensure the exception is pickleable by stripping complex objects
-        # Fabric/Invoke exceptions might contain locks or sockets
-        raise RuntimeError(f"Worker failed: {str(e)}") from None
 
 
 def handle_connection():
@@ -142,14 +162,16 @@ def handle_connection():
         overrides = {k: v for k, v in overrides.items() if v is not None}
         deployment_configs.append(overrides)
 
-    # Run in parallel
-    ctx = multiprocessing.get_context("spawn")
-
-    with concurrent.futures.ProcessPoolExecutor(mp_context=ctx) as executor:
+    # Run in parallel; workers are blocked on SSH I/O, so threads are enough
+    max_workers = min(32, len(deployment_configs))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = {
             executor.submit(deploy_worker, cfg): cfg["REMOTE_HOST"] for cfg in deployment_configs
         }
 
+        # Collect every host's outcome (like Fabric's GroupResult) before reporting failure;
+        # the executor waits for running hosts anyway, so raising early only hides results
+        failures = {}
         for future in concurrent.futures.as_completed(futures):
             host = futures[future]
             try:
@@ -157,4 +179,10 @@ def handle_connection():
                 print(f"✅ Deployment to {host} succeeded")
             except Exception as e:
                 print(f"❌ Deployment to {host} failed: {e}")
-                raise e
+                failures[host] = e
+
+    if failures:
+        first_error = next(iter(failures.values()))
+        raise RuntimeError(
+            f"Deployment failed on {len(failures)} of {len(hosts)} hosts: " + ", ".join(failures)
+        ) from first_error
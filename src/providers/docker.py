@@ -39,33 +39,21 @@ def install_docker(conn):
     if result.stdout.strip():
         print("======= Docker already installed =======")
         return
-    run_command(conn, "apt-get update", force_sudo=True)
-    run_command(
-        conn,
+    # Run every step as one privileged script instead of a round trip per step
+    steps = [
+        "apt-get update",
         "apt-get install -y apt-transport-https ca-certificates curl software-properties-common",
-        force_sudo=True,
-    )
-    run_command(
-        conn,
         "bash -c 'curl -fsSL https://download.docker.com/linux/ubuntu/gpg | apt-key add -'",
-        force_sudo=True,
-    )
-    run_command(
-        conn,
         'add-apt-repository "deb [arch=amd64] https://download.docker.com/linux/ubuntu $(lsb_release -cs) stable"',
-        force_sudo=True,
-    )
-    run_command(conn, "apt-get update", force_sudo=True)
-    run_command(conn, "apt-get install -y docker-ce", force_sudo=True)
-    run_command(
-        conn,
+        "apt-get update",
+        "apt-get install -y docker-ce",
         'curl -L "https://github.com/docker/compose/releases/download/1.29.2/docker-compose-$(uname -s)-$(uname -m)" -o /usr/local/bin/docker-compose',
-        force_sudo=True,
-    )
-    run_command(conn, "chmod +x /usr/local/bin/docker-compose", force_sudo=True)
-    run_command(conn, "usermod -aG docker ${USER}", force_sudo=True)
-    run_command(conn, "systemctl enable docker", force_sudo=True)
-    run_command(conn, "systemctl start docker", force_sudo=True)
+        "chmod +x /usr/local/bin/docker-compose",
+        "usermod -aG docker ${USER}",
+        "systemctl enable docker",
+        "systemctl start docker",
+    ]
+    run_command(conn, " && ".join(steps), force_sudo=True)
     print("======= Docker installed =======")
 
 
@@ -1,7 +1,53 @@
+import os
+import re
+import time
+import urllib.request
+
 from src import config
 from src.connection import run_command
 from src.providers.docker import docker_login
 
+KUBECTL_RELEASE_URL = "https://storage.googleapis.com/kubernetes-release/release"
+KUBECTL_VERSION_TTL = 86400
+# Versions are interpolated into the host's download command, so only plain tags are accepted
+KUBECTL_VERSION_RE = re.compile(r"^v\d+\.\d+\.\d+$")
+
+
+def resolve_kubectl_version():
+    """Return the stable kubectl version, cached locally for a day; None if it can't be fetched"""
+    cache_path = None
+    if config.HOST_STATE_CACHE:
+        cache_path = os.path.join(
+            os.path.dirname(os.path.abspath(config.HOST_STATE_CACHE)), "kubectl_stable.txt"
+        )
+        try:
+            if time.time() - os.path.getmtime(cache_path) < KUBECTL_VERSION_TTL:
+                with open(cache_path) as f:
+                    version = f.read().strip()
+                if KUBECTL_VERSION_RE.match(version):
+                    return version
+        except OSError:
+            pass
+
+    try:
+        with urllib.request.urlopen(f"{KUBECTL_RELEASE_URL}/stable.txt", timeout=10) as resp:
+            version = resp.read().decode().strip()
+    except (OSError, ValueError):
+        return None
+    if not KUBECTL_VERSION_RE.match(version):
+        return None
+
+    if cache_path:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(version)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    return version
+
 
 def install_kubectl(conn):
     """Install kubectl if not already installed"""
@@ -10,14 +56,12 @@ def install_kubectl(conn):
         print("======= kubectl already installed =======")
         return
     print("======= Installing kubectl =======")
-    version_result = conn.run(
-        "curl -s https://storage.googleapis.com/kubernetes-release/release/stable.txt", hide=True
-    )
-    latest_version = version_result.stdout.strip()
+    # Resolved on the runner (and cached) so the host only makes the binary download;
+    # fall back to asking stable.txt from the host if the runner can't reach it
+    version = resolve_kubectl_version() or f"$(curl -s {KUBECTL_RELEASE_URL}/stable.txt)"
     conn.run(
-        f"curl -LO https://storage.googleapis.com/kubernetes-release/release/{latest_version}/bin/linux/amd64/kubectl"
+        f'curl -LO "{KUBECTL_RELEASE_URL}/{version}/bin/linux/amd64/kubectl" && chmod +x ./kubectl'
     )
-    conn.run("chmod +x ./kubectl")
     run_command(conn, "mv ./kubectl /usr/local/bin/kubectl", force_sudo=True)
     print("======= kubectl installed =======")
 
@@ -31,18 +75,18 @@ def install_helm(conn):
     print("======= Installing helm =======")
     if config.REMOTE_PASSWORD:
         escaped_pwd = config.REMOTE_PASSWORD.replace("'", "'\"'\"'")
+        # The heredoc body follows the first line, so the whole chain runs in one exec
         conn.run(
-            f"cat > /tmp/helm-askpass.sh << 'HELMASKPASS_EOF'\n#!/bin/sh\nprintf '%s\\n' '{escaped_pwd}'\nHELMASKPASS_EOF",
+            "cat > /tmp/helm-askpass.sh << 'HELMASKPASS_EOF'"
+            " && chmod +x /tmp/helm-askpass.sh"
+            " && curl -s https://raw.githubusercontent.com/helm/helm/main/scripts/get-helm-3 > /tmp/get-helm-3.sh"
+            " && sed -i 's/sudo /sudo -A /g' /tmp/get-helm-3.sh"
+            " && chmod +x /tmp/get-helm-3.sh"
+            " && SUDO_ASKPASS=/tmp/helm-askpass.sh bash /tmp/get-helm-3.sh"
+            f"\n#!/bin/sh\nprintf '%s\\n' '{escaped_pwd}'\nHELMASKPASS_EOF",
+            pty=False,
             warn=False,
         )
-        conn.run("chmod +x /tmp/helm-askpass.sh", warn=False)
-        conn.run(
-            "curl -s https://raw.githubusercontent.com/helm/helm/main/scripts/get-helm-3 > /tmp/get-helm-3.sh",
-            warn=False,
-        )
-        conn.run("sed -i 's/sudo /sudo -A /g' /tmp/get-helm-3.sh", warn=False)
-        conn.run("chmod +x /tmp/get-helm-3.sh", warn=False)
-        conn.run("SUDO_ASKPASS=/tmp/helm-askpass.sh bash /tmp/get-helm-3.sh", pty=False, warn=False)
     else:
         conn.run(
             "curl https://raw.githubusercontent.com/helm/helm/main/scripts/get-helm-3 | bash",
@@ -58,10 +102,12 @@ def install_k3s(conn):
         print("======= k3s already installed =======")
         return
     print("======= Installing k3s =======")
-    conn.run('curl -sfL https://get.k3s.io | INSTALL_K3S_EXEC="--disable=traefik" sh -', pty=True)
-    run_command(conn, "systemctl enable k3s", force_sudo=True)
-    run_command(conn, "systemctl start k3s", force_sudo=True)
-    conn.run("echo 'export KUBECONFIG=/etc/rancher/k3s/k3s.yaml' >> ~/.bashrc")
+    conn.run(
+        'curl -sfL https://get.k3s.io | INSTALL_K3S_EXEC="--disable=traefik" sh - && '
+        "echo 'export KUBECONFIG=/etc/rancher/k3s/k3s.yaml' >> ~/.bashrc",
+        pty=True,
+    )
+    run_command(conn, "systemctl enable --now k3s", force_sudo=True)
     print("======= k3s installed =======")
 
 
@@ -71,28 +117,23 @@ def deploy_k8s(conn):
         docker_login(conn, registry_type=config.REGISTRY_TYPE)
         manifest_path = config.K8S_MANIFEST_PATH
         if not manifest_path:
-            for path in ["k8s", "manifests", "kubernetes"]:
-                if conn.run(f"test -d {path}", hide=True, warn=True).ok:
-                    manifest_path = path
-                    break
-            if not manifest_path:
-                for file in ["k8s.yaml", "k8s.yml", "deployment.yaml", "deployment.yml"]:
-                    if conn.run(f"test -f {file}", hide=True, warn=True).ok:
-                        manifest_path = file
-                        break
+            # Find the first conventional manifest dir or file in one round trip
+            probe = conn.run(
+                'for d in k8s manifests kubernetes; do [ -d "$d" ] && echo "$d" && exit 0; done; '
+                "for f in k8s.yaml k8s.yml deployment.yaml deployment.yml; do "
+                '[ -f "$f" ] && echo "$f" && exit 0; done; exit 1',
+                hide=True,
+                warn=True,
+            )
+            if probe.ok:
+                manifest_path = probe.stdout.strip()
         if not manifest_path:
             raise ValueError("No k8s_manifest_path specified and no k8s manifests found.")
         print(f"======= Deploying to Kubernetes using: {manifest_path} =======")
-        kubeconfig_cmd = "export KUBECONFIG=/etc/rancher/k3s/k3s.yaml"
+        # kubectl apply -f accepts files and directories alike, so namespace + apply share one exec
         conn.run(
-            f"{kubeconfig_cmd} && kubectl create namespace {config.K8S_NAMESPACE} --dry-run=client -o yaml | kubectl apply -f -"
+            "export KUBECONFIG=/etc/rancher/k3s/k3s.yaml"
+            f" && kubectl create namespace {config.K8S_NAMESPACE} --dry-run=client -o yaml | kubectl apply -f -"
+            f" && kubectl apply -f {manifest_path} -n {config.K8S_NAMESPACE}"
         )
-        if conn.run(f"test -d {manifest_path}", warn=True, hide=True).ok:
-            conn.run(
-                f"{kubeconfig_cmd} && kubectl apply -f {manifest_path}/ -n {config.K8S_NAMESPACE}"
-            )
-        else:
-            conn.run(
-                f"{kubeconfig_cmd} && kubectl apply -f {manifest_path} -n {config.K8S_NAMESPACE}"
-            )
     print("======= Kubernetes deployment completed =======")
@@ -1,89 +1,236 @@
+import functools
+import re
+import shlex
+import weakref
+
+import yaml
+
 from src import config
 from src.connection import run_command
 
+# Substring that identifies each database (grep -i semantics: "postgres" also covers
+# "postgresql", "mongo" covers "mongodb", ...)
+DB_MATCH_TERMS = {
+    "postgres": "postgres",
+    "mariadb": "mariadb",
+    "mysql": "mysql",
+    "mongodb": "mongo",
+    "redis": "redis",
+}
+COMPOSE_FILES = ["docker-compose.yml", "docker-compose.yaml", "compose.yml", "compose.yaml"]
+K8S_MANIFEST_DIRS = ["k8s", "manifests", "kubernetes"]
+
+# db_type -> (data dir name searched on disk, uid, gid, mode)
+DB_PERMISSIONS = {
+    "postgres": ("postgres", "999", "999", "700"),
+    "mariadb": ("mariadb", "999", "999", "750"),
+    "mysql": ("mysql", "999", "999", "750"),
+    "mongodb": ("mongodb", "999", "999", "755"),
+    "redis": ("redis", "999", "999", "755"),
+}
+# Existing data dirs used per database (on top of the compose volume paths)
+MAX_DATA_DIRS = 10
+
+# libyaml-backed loader when available, same results as SafeLoader
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Host side of a volume line: optional list dash, then a ./ or / path up to the first ":/"
+_VOLUME_HOST_PATH = re.compile(r"^[ \t]*-*[ \t]*(\.?/[^\n]*?)[ \t]*:/", re.M)
+# YAML list item, used when a compose file doesn't parse
+_LIST_ITEM = re.compile(r"\s+-\s+")
+
+# Prefix of the section lines separating the parts of a batched probe's stdout
+_SECTION_MARKER = "@@metaldeploy:"
+
+# Per-connection detection results:
+# {conn: {(subdir, deployment_type): (databases, {compose_file: content}, data_dirs)}}
+_DETECT_CACHE = weakref.WeakKeyDictionary()
+
+
+def _quote_path(path):
+    """shlex.quote, leaving a leading ~ unquoted so the remote shell still expands it"""
+    if path == "~":
+        return path
+    if path.startswith("~/"):
+        return "~/" + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+
+def _in_subdir(script):
+    """Run script from GIT_SUBDIR; one explicit cd instead of conn.cd wrapping every call"""
+    return f"cd {_quote_path(config.GIT_SUBDIR)} && {{ {script}; }}"
+
+
+def _split_sections(output):
+    """Split batched probe output into {section name: text} on _SECTION_MARKER lines"""
+    sections = {}
+    current = None
+    for line in output.split("\n"):
+        if line.startswith(_SECTION_MARKER):
+            current = line[len(_SECTION_MARKER) :].strip()
+            sections[current] = []
+        elif current is not None:
+            sections[current].append(line)
+    return {name: "\n".join(lines) for name, lines in sections.items()}
+
+
+def _compose_read_script():
+    # Trailing echo keeps the next marker on its own line when a file lacks a final newline
+    return (
+        f"for f in {' '.join(COMPOSE_FILES)}; do "
+        f'[ -f "$f" ] && echo "{_SECTION_MARKER}file:$f" && cat "$f" && echo; done'
+    )
+
+
+def _compose_contents(sections):
+    prefix = "file:"
+    return {name[len(prefix) :]: text for name, text in sections.items() if name.startswith(prefix)}
+
+
+def _read_compose_files(conn):
+    """{compose_file: content} from the last detection on this connection, else read in one call"""
+    cached = _DETECT_CACHE.get(conn, {}).get((config.GIT_SUBDIR, config.DEPLOYMENT_TYPE))
+    if cached:
+        return cached[1]
+    result = conn.run(_in_subdir(f"{_compose_read_script()}; true"), hide=True, warn=True)
+    return _compose_contents(_split_sections(result.stdout))
+
+
+def _data_dirs_find(dir_names):
+    # One walk for every database; VCS/dependency trees are skipped since they never
+    # hold database data and dominate the walk
+    names = " -o ".join(f"-name '*{name}*'" for name in dir_names)
+    # The MAX_DATA_DIRS cap applies per name, so one database with many matching dirs
+    # can't crowd out the others; a dir is kept while any name it matches has room
+    keep = (
+        f"awk -v max={MAX_DATA_DIRS} 'BEGIN {{ n = split(\"{' '.join(dir_names)}\", names, \" \") }}"
+        ' { base = $0; sub(/.*\\//, "", base); keep = 0'
+        "; for (i = 1; i <= n; i++) if (index(base, names[i]) && seen[i] < max) { seen[i]++; keep = 1 } }"
+        " keep'"
+    )
+    return (
+        "LC_ALL=C find . \\( -name .git -o -name node_modules \\) -prune -o -type d"
+        f" \\( {names} \\) \\( -path '*/data/*' -o -path '*/volumes/*' \\) -print"
+        f" 2>/dev/null | {keep}"
+    )
+
 
 def detect_database_type(conn):
     """Detect which database is being used in the deployment"""
-    databases = []
-    with conn.cd(config.GIT_SUBDIR):
-        db_patterns = {
-            "postgres": ["postgres", "postgresql", "postgres:"],
-            "mariadb": ["mariadb", "mariadb:"],
-            "mysql": ["mysql", "mysql:"],
-            "mongodb": ["mongo", "mongodb", "mongo:"],
-            "redis": ["redis", "redis:"],
-        }
-        compose_files = ["docker-compose.yml", "docker-compose.yaml", "compose.yml", "compose.yaml"]
-        for compose_file in compose_files:
-            check = conn.run(
-                f"test -f {compose_file} && echo 'exists' || echo 'not exists'",
-                hide=True,
-                warn=True,
-            )
-            if "exists" in check.stdout:
-                for db_type, patterns in db_patterns.items():
-                    if db_type in databases:
-                        continue
-                    for pattern in patterns:
-                        result = conn.run(
-                            f"grep -i '{pattern}' {compose_file} 2>/dev/null | head -1 || true",
-                            hide=True,
-                            warn=True,
-                        )
-                        if result.stdout.strip():
-                            databases.append(db_type)
-                            break
-        if config.DEPLOYMENT_TYPE == "k8s":
-            manifest_paths = ["k8s", "manifests", "kubernetes"]
-            for path in manifest_paths:
-                check = conn.run(
-                    f"test -d {path} && echo 'exists' || echo 'not exists'", hide=True, warn=True
-                )
-                if "exists" in check.stdout:
-                    for db_type, patterns in db_patterns.items():
-                        if db_type in databases:
-                            continue
-                        for pattern in patterns:
-                            result = conn.run(
-                                f"grep -ri '{pattern}' {path}/ 2>/dev/null | head -1 || true",
-                                hide=True,
-                                warn=True,
-                            )
-                            if result.stdout.strip():
-                                databases.append(db_type)
-                                break
-    return databases
+    key = (config.GIT_SUBDIR, config.DEPLOYMENT_TYPE)
+    cached = _DETECT_CACHE.get(conn, {}).get(key)
+    if cached:
+        return list(cached[0])
+
+    # One round trip does all the remote work for fix_database_permissions:
+    # - every existing compose file is fetched (they're small; detection and volume
+    #   extraction both parse them on this side)
+    # - for k8s, the manifest dirs are grepped for the database names, printing only the
+    #   matches. The names are plain ASCII, so the C locale avoids multibyte decoding
+    # - if any database name shows up at all, existing data dirs are listed by one find
+    alternation = "|".join(DB_MATCH_TERMS.values())
+    script = _compose_read_script()
+    mentions = f"LC_ALL=C grep -Eqsi '{alternation}' {' '.join(COMPOSE_FILES)}"
+    if config.DEPLOYMENT_TYPE == "k8s":
+        script += (
+            f"; echo '{_SECTION_MARKER}k8s'; LC_ALL=C grep -Eirohs '{alternation}'"
+            f" {' '.join(K8S_MANIFEST_DIRS)}"
+            # Print each name once and stop as soon as all of them were seen: awk exiting
+            # closes the pipe, so grep quits instead of scanning the remaining manifests
+            f" | awk '{{ t = tolower($0) }} !(t in seen) {{ seen[t]; print t; n++ }}"
+            f" n == {len(DB_MATCH_TERMS)} {{ exit }}'"
+        )
+        mentions += f" || LC_ALL=C grep -Eqrsi '{alternation}' {' '.join(K8S_MANIFEST_DIRS)}"
+    dir_names = [dir_name for dir_name, *_ in DB_PERMISSIONS.values()]
+    script += (
+        f"; if {mentions}; then echo '{_SECTION_MARKER}dirs'; {_data_dirs_find(dir_names)}; fi"
+    )
+    result = conn.run(_in_subdir(f"{script}; true"), hide=True, warn=True)
+    sections = _split_sections(result.stdout)
+    compose = _compose_contents(sections)
+    haystack = "\n".join([*compose.values(), sections.get("k8s", "")]).lower()
+    databases = [db_type for db_type, term in DB_MATCH_TERMS.items() if term in haystack]
+    data_dirs = [line.strip() for line in sections.get("dirs", "").split("\n") if line.strip()]
+    _DETECT_CACHE.setdefault(conn, {})[key] = (databases, compose, data_dirs)
+    return list(databases)
+
+
+def _parse_volume_paths(output):
+    """Host paths from compose volume lines like '- ./data/db:/var/lib/db'"""
+    return _VOLUME_HOST_PATH.findall(output)
+
+
+@functools.lru_cache(maxsize=32)
+def _load_compose(content):
+    """Parsed compose document, or None when it isn't valid YAML"""
+    try:
+        return yaml.load(content, Loader=_YAML_LOADER)
+    except yaml.YAMLError:
+        return None
+
+
+def _compose_volume_entries(content):
+    """Volume mounts of every service as 'source:target' strings, or None if unparseable"""
+    data = _load_compose(content)
+    services = data.get("services") if isinstance(data, dict) else None
+    if not isinstance(services, dict):
+        return None
+    entries = []
+    for service in services.values():
+        if not isinstance(service, dict):
+            continue
+        for volume in service.get("volumes") or []:
+            if isinstance(volume, dict):
+                # Long syntax: {type: bind, source: ./data, target: /var/lib/...}
+                volume = f"{volume.get('source', '')}:{volume.get('target', '')}"
+            if isinstance(volume, str):
+                entries.append(volume)
+    return entries
+
+
+def _compose_volume_paths(compose, db_type):
+    """Host paths of the compose volume mounts that mention db_type"""
+    # dict keys: O(1) de-duplication that keeps first-seen order
+    paths = {}
+    pattern = re.compile(rf"{re.escape(db_type)}.*:/", re.IGNORECASE)
+    for content in compose.values():
+        entries = _compose_volume_entries(content)
+        if entries is None:
+            # Not a structured compose file: fall back to scanning list-item lines
+            entries = [line for line in content.split("\n") if _LIST_ITEM.match(line)]
+        paths.update(
+            dict.fromkeys(_parse_volume_paths("\n".join(e for e in entries if pattern.search(e))))
+        )
+    return list(paths)
 
 
 def get_database_volume_paths(conn, db_type):
     """Extract actual volume paths from docker-compose files"""
-    paths = []
-    with conn.cd(config.GIT_SUBDIR):
-        compose_files = ["docker-compose.yml", "docker-compose.yaml", "compose.yml", "compose.yaml"]
-        for compose_file in compose_files:
-            check = conn.run(
-                f"test -f {compose_file} && echo 'exists' || echo 'not exists'",
-                hide=True,
-                warn=True,
-            )
-            if "exists" not in check.stdout:
-                continue
-            volume_result = conn.run(
-                f"grep -iE '\\s+-\\s+.*{db_type}.*:/' {compose_file} 2>/dev/null || true",
-                hide=True,
-                warn=True,
-            )
-            for line in volume_result.stdout.strip().split("\n"):
-                line = line.strip()
-                if ":/" in line:
-                    parts = line.split(":/")
-                    if len(parts) > 0:
-                        local_path = parts[0].strip().lstrip("-").strip()
-                        if local_path and (
-                            local_path.startswith("./") or local_path.startswith("/")
-                        ):
-                            if local_path not in paths:
-                                paths.append(local_path)
+    return _compose_volume_paths(_read_compose_files(conn), db_type)
+
+
+def _collect_database_paths(conn, db_dirs):
+    """Volume paths and existing data dirs for every database
+
+    db_dirs maps db_type to the directory name searched for on disk. Compose files and
+    data dirs come from detection; without it they're fetched in a round trip each.
+    """
+    compose = _read_compose_files(conn)
+    cached = _DETECT_CACHE.get(conn, {}).get((config.GIT_SUBDIR, config.DEPLOYMENT_TYPE))
+    if cached:
+        data_dirs = cached[2]
+    else:
+        result = conn.run(
+            _in_subdir(f"{_data_dirs_find(list(db_dirs.values()))}; true"), hide=True, warn=True
+        )
+        data_dirs = [line.strip() for line in result.stdout.split("\n") if line.strip()]
+
+    paths = {}
+    for db_type, dir_name in db_dirs.items():
+        volume_paths = _compose_volume_paths(compose, db_type)
+        # find matched the name against the last path component
+        matching = [d for d in data_dirs if dir_name in d.rsplit("/", 1)[-1]][:MAX_DATA_DIRS]
+        paths[db_type] = list(dict.fromkeys([*volume_paths, *matching]))
     return paths
 
 
@@ -92,40 +239,32 @@ def fix_database_permissions(conn):
     databases = detect_database_type(conn)
     if not databases:
         return
-    db_configs = {
-        "postgres": ("postgres", "999", "999", "700"),
-        "mariadb": ("mariadb", "999", "999", "750"),
-        "mysql": ("mysql", "999", "999", "750"),
-        "mongodb": ("mongodb", "999", "999", "755"),
-        "redis": ("redis", "999", "999", "755"),
-    }
-    with conn.cd(config.GIT_SUBDIR):
-        for db_type in databases:
-            if db_type not in db_configs:
-                continue
-            dir_name, user_id, group_id, perms = db_configs[db_type]
-            volume_paths = get_database_volume_paths(conn, db_type)
-            existing_dirs = conn.run(
-                f"find . -type d -name '*{dir_name}*' -path '*/data/*' -o -type d -name '*{dir_name}*' -path '*/volumes/*' 2>/dev/null | head -10 || true",
-                hide=True,
-                warn=True,
+    db_configs = DB_PERMISSIONS
+    databases = [db_type for db_type in databases if db_type in db_configs]
+    all_paths = _collect_database_paths(
+        conn, {db_type: db_configs[db_type][0] for db_type in databases}
+    )
+    # Every path of every database is fixed in a single exec; each step stays best-effort
+    fix_steps = []
+    for db_type in databases:
+        _, user_id, group_id, perms = db_configs[db_type]
+        volume_paths = [path for path in all_paths[db_type] if path.strip()]
+        if not volume_paths:
+            continue
+        print(f"======= Fixing {db_type.upper()} data directory permissions =======")
+        full_paths = []
+        for path in volume_paths:
+            normalized_path = path.lstrip("./")
+            full_paths.append(
+                f"./{normalized_path}" if not normalized_path.startswith("/") else normalized_path
             )
-            for existing_dir in existing_dirs.stdout.strip().split("\n"):
-                if existing_dir.strip() and existing_dir.strip() not in volume_paths:
-                    volume_paths.append(existing_dir.strip())
-            if not volume_paths:
-                continue
-            print(f"======= Fixing {db_type.upper()} data directory permissions =======")
-            for path in volume_paths:
-                if not path.strip():
-                    continue
-                normalized_path = path.lstrip("./")
-                full_path = (
-                    f"./{normalized_path}"
-                    if not normalized_path.startswith("/")
-                    else normalized_path
-                )
-                run_command(
-                    conn,
-                    f"bash -c 'mkdir -p {full_path} || true && chown -R {user_id}:{group_id} {full_path} || true && chmod -R {perms} {full_path} || true'",
-                )
+        fix_steps.append(
+            f"for p in {' '.join(shlex.quote(p) for p in full_paths)}; do "
+            f'mkdir -p "$p" || true; chown -R {user_id}:{group_id} "$p" || true; '
+            f'chmod -R {perms} "$p" || true; done'
+        )
+    if fix_steps:
+        # conn.cd applies the cd in the deploy user's shell before run_command's sudo wrapper,
+        # so a ~-based GIT_SUBDIR resolves to the same home the detection probe used
+        with conn.cd(config.GIT_SUBDIR):
+            run_command(conn, "; ".join(fix_steps))
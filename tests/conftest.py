@@ -1,18 +1,34 @@
 import os
+import re
+
+import pytest
 
 # Load .env.test from root into environment
 env_test_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env.test")
+# KEY=VALUE lines, ignoring blanks/comments; surrounding whitespace is trimmed off both sides
+# (the lookahead also rejects whitespace, so backtracking can't let an indented # through)
+ENV_LINE = re.compile(r"^[ \t]*(?![#\s])([^=\n]*[^=\s])[ \t]*=[ \t]*(.*?)[ \t\r]*$", re.M)
+
+
+def _unquote(value):
+    # Strip surrounding quotes if present
+    if value[:1] in ('"', "'") and value.endswith(value[:1]):
+        return value[1:-1]
+    return value
+
+
 if os.path.exists(env_test_path):
     with open(env_test_path, "r") as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, value = line.split("=", 1)
-                value = value.strip()
-                # Strip surrounding quotes if present
-                if (value.startswith('"') and value.endswith('"')) or (
-                    value.startswith("'") and value.endswith("'")
-                ):
-                    value = value[1:-1]
-                # Unescape \n to real newlines for blobs
-                os.environ[key.strip()] = value.replace("\\n", "\n")
+        text = f.read()
+    # Unescape \n to real newlines for blobs
+    os.environ.update(
+        {key: _unquote(value).replace("\\n", "\n") for key, value in ENV_LINE.findall(text)}
+    )
+
+
+@pytest.fixture(autouse=True)
+def isolated_host_state(tmp_path, monkeypatch):
+    """Keep the install-state cache out of the real home directory during tests"""
+    from src.config import config
+
+    monkeypatch.setattr(config, "HOST_STATE_CACHE", str(tmp_path / "host_state.sqlite"))
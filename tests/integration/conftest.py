@@ -6,6 +6,40 @@ import pytest
 from fabric import Connection
 
 
+class SSHPool:
+    """Session-wide cache of open connections keyed by (host, port, user)"""
+
+    def __init__(self, password):
+        self.password = password
+        self._conns = {}
+
+    def get_or_create(self, host, port, user):
+        key = (host, int(port), user)
+        conn = self._conns.get(key)
+        if conn is None:
+            conn = Connection(
+                host=host,
+                port=int(port),
+                user=user,
+                connect_timeout=5,
+                connect_kwargs={
+                    "password": self.password,
+                    "look_for_keys": False,
+                    "allow_agent": False,
+                    "banner_timeout": 10,
+                },
+            )
+            # Handshake now so a broken endpoint isn't cached
+            conn.open()
+            self._conns[key] = conn
+        return conn
+
+    def close_all(self):
+        for conn in self._conns.values():
+            conn.close()
+        self._conns.clear()
+
+
 @pytest.fixture(scope="session")
 def ssh_container():
     """Spin up the Docker container with SSH server."""
@@ -14,80 +48,97 @@ def ssh_container():
     docker_compose_file = os.path.join(os.path.dirname(__file__), "docker-compose.yml")
     tests_dir = os.path.dirname(__file__)
 
+    # Under pytest-xdist (-n N) every worker runs its own pair of containers: a separate
+    # compose project on its own ports, with its own directory in the shared test volume
+    worker = os.environ.get("PYTEST_XDIST_WORKER", "")
+    offset = 2 * int(worker[2:]) if worker.startswith("gw") else 0
+    ports = [2222 + offset, 2223 + offset]
+    compose = ["docker", "compose", "-f", docker_compose_file]
+    if worker:
+        compose += ["-p", f"metaldeploy-tests-{worker}"]
+    compose_env = {
+        **os.environ,
+        "METALDEPLOY_SSH_PORT": str(ports[0]),
+        "METALDEPLOY_SSH_PORT_2": str(ports[1]),
+    }
+
     # Start container with output capture
     print("🐳 Starting SSH container...")
-    result = subprocess.run(
-        ["docker", "compose", "-f", docker_compose_file, "up", "-d"],
-        capture_output=True,
+    # stderr is folded into stdout so a failure reports build and start output in order
+    # from a single pipe
+    proc = subprocess.Popen(
+        [*compose, "up", "-d"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
         text=True,
         stdin=subprocess.DEVNULL,
         cwd=tests_dir,
+        env=compose_env,
     )
+    output, _ = proc.communicate()
 
-    if result.returncode != 0:
-        print(f"❌ Docker compose failed: {result.stderr}")
-        pytest.fail(f"Failed to start Docker container: {result.stderr}")
-
-    # Give container time to fully start sshd
-    time.sleep(5)
+    if proc.returncode != 0:
+        print(f"❌ Docker compose failed: {output}")
+        pytest.fail(f"Failed to start Docker container: {output}")
 
     # Connection parameters
     host = "127.0.0.1"
-    ports = [2222, 2223]
     user = "root"
     password = "root"
 
-    # Wait for SSH to be ready with socket check first
-    retries = 30
+    # Wait for SSH to be ready with socket check first, polling with exponential
+    # backoff instead of a fixed startup sleep
+    timeout = 60
+    deadline = time.monotonic() + timeout
+    delay = 0.05
     ready = False
+    # Connections that pass the readiness check stay open in the pool and are shared by
+    # every test, so each host costs a single SSH handshake per session
+    pool = SSHPool(password)
 
-    for i in range(retries):
+    while True:
         try:
-            # Check if ports are listening
             for port in ports:
-                with socket.create_connection((host, port), timeout=2):
-                    pass
+                # Docker's port proxy accepts connections before sshd is up, so wait for
+                # the server's identification banner; the (slower) SSH handshake is only
+                # attempted once sshd is actually answering
+                with socket.create_connection((host, port), timeout=2) as sock:
+                    if not sock.recv(4).startswith(b"SSH-"):
+                        raise ConnectionError(f"no SSH banner on port {port}")
 
                 # Verify SSH actually works
-                conn = Connection(
-                    host=host,
-                    port=port,
-                    user=user,
-                    connect_kwargs={
-                        "password": password,
-                        "look_for_keys": False,
-                        "allow_agent": False,
-                    },
-                )
-                conn.run("echo 'SSH Ready'", hide=True)
-                conn.close()
+                pool.get_or_create(host, port, user).run("echo 'SSH Ready'", hide=True)
 
             ready = True
             print("✅ SSH Containers Ready")
             break
         except Exception as e:
-            if i < retries - 1:
-                time.sleep(1)
-            else:
+            if time.monotonic() >= deadline:
                 print(f"Final connection attempt failed: {e}")
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
 
     if not ready:
+        pool.close_all()
         # Capture logs before failing
         logs = subprocess.run(
-            ["docker", "compose", "-f", docker_compose_file, "logs"],
+            [*compose, "logs"],
             capture_output=True,
             text=True,
             stdin=subprocess.DEVNULL,
             cwd=tests_dir,
+            env=compose_env,
         )
         print(f"Container logs:\n{logs.stdout}")
         subprocess.run(
-            ["docker", "compose", "-f", docker_compose_file, "down"],
+            [*compose, "down"],
             check=False,
             stdin=subprocess.DEVNULL,
             cwd=tests_dir,
+            env=compose_env,
         )
-        pytest.fail("Could not connect to SSH containers after 30 retries")
+        pytest.fail(f"Could not connect to SSH containers within {timeout}s")
 
     yield {
         "host": host,
@@ -95,28 +146,65 @@ def ssh_container():
         "second_port": ports[1],
         "user": user,
         "password": password,
+        "pool": pool,
+        "base_dir": f"/opt/metaldeploy_tests/{worker}".rstrip("/"),
     }
 
     # Teardown
+    pool.close_all()
     print("🛑 Stopping SSH container...")
     subprocess.run(
-        ["docker", "compose", "-f", docker_compose_file, "down"],
+        [*compose, "down"],
         check=False,
         stdin=subprocess.DEVNULL,
         cwd=tests_dir,
+        env=compose_env,
     )
 
 
-@pytest.fixture
-def integration_conn(ssh_container):
-    """Provide a fabric connection to the container."""
-    return Connection(
-        host=ssh_container["host"],
-        port=ssh_container["port"],
-        user=ssh_container["user"],
-        connect_kwargs={
-            "password": ssh_container["password"],
-            "look_for_keys": False,
-            "allow_agent": False,
-        },
+@pytest.fixture(scope="session")
+def ssh_pool(ssh_container):
+    """Open connections to the test containers, shared across the session"""
+    return ssh_container["pool"]
+
+
+@pytest.fixture(scope="session")
+def integration_conn(ssh_container, ssh_pool):
+    """Provide a fabric connection to the container.
+
+    Session-scoped: the already-open connection from the readiness check is reused,
+    so the whole run pays for a single SSH handshake.
+    """
+    return ssh_pool.get_or_create(
+        ssh_container["host"], ssh_container["port"], ssh_container["user"]
+    )
+
+
+@pytest.fixture(scope="session")
+def multi_host_conns(ssh_container, ssh_pool):
+    """Open connections to both test containers, for checks after multi-host runs"""
+    return tuple(
+        ssh_pool.get_or_create(ssh_container["host"], port, ssh_container["user"])
+        for port in (ssh_container["port"], ssh_container["second_port"])
+    )
+
+
+@pytest.fixture(scope="session")
+def artifact_corpus(tmp_path_factory):
+    """Local files shared by the artifact and file-path-secret tests, written once per session
+
+    dist_1/ holds a single app.js and dist_500/ the same plus 499 small chunks.
+    """
+    base = tmp_path_factory.mktemp("corpus")
+    for n_files in (1, 500):
+        dist = base / f"dist_{n_files}"
+        (dist / "assets").mkdir(parents=True)
+        (dist / "app.js").write_text("console.log('hello');")
+        for i in range(1, n_files):
+            (dist / "assets" / f"chunk_{i}.js").write_text(f"export const n = {i};")
+    (base / "jenkins_secret.json").write_text(
+        '{"FILE_DB_USER": "file-user-admin", "FILE_DB_PASS": "file-secret-pass"}'
     )
+    (base / "jenkins_secret.yaml").write_text("HOST: yaml-file-host\nPORT: 6379")
+    (base / "jenkins_secret.env").write_text("S3_BUCKET=file-bucket\nS3_REGION=us-east-1")
+    return base
@@ -1,3 +1,12 @@
+import base64
+import concurrent.futures
+import hashlib
+import io
+import os
+import shlex
+import tarfile
+from unittest.mock import patch
+
 import pytest
 
 from src.config import config
@@ -5,30 +14,55 @@ from src.env_manager import generate_env_files
 
 
 @pytest.fixture
-def clean_remote_dir(integration_conn):
+def clean_remote_dir(integration_conn, ssh_container):
     """Fixture to provide clean directories for each test."""
-    base_dir = "/opt/metaldeploy_tests"
-    integration_conn.run(f"mkdir -p {base_dir}")
+    # Per xdist worker, so tests running in parallel never share a directory
+    base_dir = ssh_container["base_dir"]
 
-    def _clean(subdir):
+    def _clean(subdir, extra_mkdirs=()):
         target = f"{base_dir}/{subdir}"
-        integration_conn.run(f"rm -rf {target} && mkdir -p {target} && chmod 777 {target}")
+        # install -d creates base_dir on the way and sets the mode in the same process, so
+        # each test's setup is a single round trip with no separate base-dir step
+        script = f"rm -rf {target} && install -d -m 0777 {target}"
+        if extra_mkdirs:
+            script += f" && mkdir -p {' '.join(extra_mkdirs)}"
+        integration_conn.run(script)
         return target
 
     return _clean
 
 
+def assert_files_content(conn, specs):
+    """Assert existence and content of several remote files, read in one round trip
+
+    specs is a list of (path, expected_substrings[, forbidden_substrings]) tuples.
+    """
+    specs = [(spec[0], spec[1], spec[2] if len(spec) > 2 else None) for spec in specs]
+    paths = " ".join(shlex.quote(path) for path, _, _ in specs)
+    # -P keeps the absolute member names; pipefail surfaces a missing file from tar
+    result = conn.run(
+        f"set -o pipefail; tar -cPf - {paths} | base64 -w0", hide=True, warn=True, pty=False
+    )
+    assert result.ok, f"Files not found: {result.stderr.strip()}"
+    with tarfile.open(fileobj=io.BytesIO(base64.b64decode(result.stdout))) as tar:
+        contents = {
+            member.name: tar.extractfile(member).read().decode()
+            for member in tar.getmembers()
+            if member.isfile()
+        }
+    for path, expected_substrings, forbidden_substrings in specs:
+        assert path in contents, f"File not found: {path}"
+        content = contents[path]
+        # One pass per list; a failure reports every offending substring at once
+        missing = [sub for sub in expected_substrings if sub not in content]
+        assert not missing, f"Substrings {missing} not found in {path}. Content:\n{content}"
+        found = [sub for sub in forbidden_substrings or () if sub in content]
+        assert not found, f"Forbidden substrings {found} found in {path}. Content:\n{content}"
+
+
 def assert_file_content(conn, path, expected_substrings, forbidden_substrings=None):
     """Helper to assert file existence and content."""
-    assert conn.run(f"test -f {path}", warn=True).ok, f"File not found: {path}"
-    content = conn.run(f"cat {path}", hide=True).stdout
-    for sub in expected_substrings:
-        assert sub in content, f"Substring '{sub}' not found in {path}. Content:\n{content}"
-    if forbidden_substrings:
-        for sub in forbidden_substrings:
-            assert (
-                sub not in content
-            ), f"Forbidden substring '{sub}' found in {path}. Content:\n{content}"
+    assert_files_content(conn, [(path, expected_substrings, forbidden_substrings)])
 
 
 @pytest.mark.integration
@@ -39,15 +73,16 @@ def test_ssh_connection(integration_conn):
 
 
 @pytest.mark.integration
-def test_artifact_copying(integration_conn, clean_remote_dir, monkeypatch, tmp_path):
-    """Test copying local artifacts to remote."""
-    # 1. Setup local artifact
-    local_dir = tmp_path / "dist"
-    local_dir.mkdir()
-    (local_dir / "app.js").write_text("console.log('hello');")
+@pytest.mark.parametrize("n_files", [1, pytest.param(500, marks=pytest.mark.slow)])
+def test_artifact_copying(
+    integration_conn, clean_remote_dir, monkeypatch, artifact_corpus, n_files
+):
+    """Test copying local artifacts to remote (a single file and a bulk tree)."""
+    # 1. Local artifact from the session corpus
+    local_dir = artifact_corpus / f"dist_{n_files}"
 
     # 2. Setup config
-    remote_base = clean_remote_dir("artifact_test")
+    remote_base = clean_remote_dir(f"artifact_test_{n_files}")
     # Clean remote dir creates the dir, but our logic also mkdir -p parent.
     # We want to put 'dist' inside 'remote_base'
     remote_target = f"{remote_base}/app_dist"
@@ -61,37 +96,39 @@ def test_artifact_copying(integration_conn, clean_remote_dir, monkeypatch, tmp_p
     copy_artifacts(integration_conn)
 
     # 4. Verify
-    # Since we copied directory 'dist' to 'remote_target' (app_dist)
-    # The layout depends on how we tarred it.
     # Logic: tar.add(local_dir, arcname=basename(remote_target)) -> app_dist/...
     # Extract into parent of remote_target (remote_base) -> remote_base/app_dist
-
-    result = integration_conn.run(f"ls -R {remote_target}", warn=True)
-    assert result.ok
-    assert "app.js" in result.stdout
-
-    content = integration_conn.run(f"cat {remote_target}/app.js", hide=True).stdout
-    assert "console.log('hello');" in content
+    # Every file's checksum comes back from one remote command, whatever n_files is
+    result = integration_conn.run(
+        f"cd {remote_target} && find . -type f -print0 | sort -z | xargs -0 sha256sum",
+        hide=True,
+        warn=True,
+    )
+    assert result.ok, result.stderr
+    remote = {}
+    for line in result.stdout.splitlines():
+        digest, _, name = line.partition("  ")
+        remote[name[2:]] = digest
+    expected = {
+        path.relative_to(local_dir).as_posix(): hashlib.sha256(path.read_bytes()).hexdigest()
+        for path in local_dir.rglob("*")
+        if path.is_file()
+    }
+    assert "app.js" in expected and len(expected) == n_files
+    assert remote == expected
 
 
 @pytest.mark.integration
-def test_multi_host_execution(ssh_container, clean_remote_dir, monkeypatch, capsys):
+def test_multi_host_execution(
+    ssh_container, multi_host_conns, clean_remote_dir, monkeypatch, capsys
+):
     """Test deploying to multiple hosts in parallel."""
-    from fabric import Connection
-
     from src.orchestrator import handle_connection
 
     # 1. Setup Config
     host1 = f"{ssh_container['host']}:{ssh_container['port']}"
     host2 = f"{ssh_container['host']}:{ssh_container['second_port']}"
 
-    monkeypatch.setenv("REMOTE_HOST", f"{host1}, {host2}")
-    monkeypatch.setenv("REMOTE_USER", ssh_container["user"])
-    monkeypatch.setenv("REMOTE_PASSWORD", ssh_container["password"])
-    monkeypatch.setenv("ENV_FILES_GENERATE", "false")  # Simplify
-    monkeypatch.setenv("DEPLOYMENT_TYPE", "baremetal")
-    monkeypatch.setenv("DEPLOY_COMMAND", "echo deployment_simulated")
-
     # 2. Run
     # We need to handle the fact that 'clean_remote_dir' only cleans the first one usually?
     # Actually clean_remote_dir fixture uses 'integration_conn' which uses port 2222.
@@ -99,28 +136,34 @@ def test_multi_host_execution(ssh_container, clean_remote_dir, monkeypatch, caps
     # But code does 'mkdir -p REMOTE_DIR'.
     # We'll rely on unique dir names to avoid conflict if dirty.
 
-    target_dir = "/opt/metaldeploy_tests/multi_host_test"
-    monkeypatch.setenv("REMOTE_DIR", target_dir)
-    monkeypatch.setenv("GIT_DIR", f"{target_dir}/repo")
+    target_dir = f"{ssh_container['base_dir']}/multi_host_test"
+    deploy_env = {
+        "REMOTE_HOST": f"{host1}, {host2}",
+        "REMOTE_USER": ssh_container["user"],
+        "REMOTE_PASSWORD": ssh_container["password"],
+        "ENV_FILES_GENERATE": "false",  # Simplify
+        "DEPLOYMENT_TYPE": "baremetal",
+        "DEPLOY_COMMAND": "echo deployment_simulated",
+        "REMOTE_DIR": target_dir,
+        "GIT_DIR": f"{target_dir}/repo",
+    }
 
-    # Reload config in main process so it picks up the env vars
-    config.load()
+    # Worker threads build their config from the env vars (config.bind); the main
+    # thread only reads the host list and credentials, so patch just those instead of a
+    # full config.load() that would also outlive the test
+    for key in ("REMOTE_HOST", "REMOTE_USER", "REMOTE_PASSWORD"):
+        monkeypatch.setattr(config, key, deploy_env[key])
 
-    # Run orchestration
-    handle_connection()
+    # Run orchestration; the environment is applied in one update and restored on exit
+    with patch.dict(os.environ, deploy_env):
+        handle_connection()
 
-    # 3. Verify on Host 1
-    conn_args = {
-        "password": ssh_container["password"],
-        "look_for_keys": False,
-        "allow_agent": False,
-    }
-    conn1 = Connection(host=host1, user=ssh_container["user"], connect_kwargs=conn_args)
+    # 3. Verify on both hosts (reusing the session's already-authenticated connections)
+    conn1, conn2 = multi_host_conns
     res1 = conn1.run(f"test -d {target_dir}", warn=True)
     assert res1.ok
 
     # 4. Verify on Host 2
-    conn2 = Connection(host=host2, user=ssh_container["user"], connect_kwargs=conn_args)
     res2 = conn2.run(f"test -d {target_dir}", warn=True)
     assert res2.ok
 
@@ -131,95 +174,77 @@ def test_multi_host_execution(ssh_container, clean_remote_dir, monkeypatch, caps
 
 
 @pytest.mark.integration
-def test_env_exhaustive_multi_env_nested(integration_conn, clean_remote_dir, monkeypatch):
+@pytest.mark.parametrize(
+    "structure,environments,expected",
+    [
+        # Coexistence: dev, staging and prod nested side by side from standard .env blobs
+        pytest.param(
+            "nested",
+            ["dev", "staging", "prod"],
+            [
+                (".envs/dev/.env.app", ["PORT=8000"]),
+                (".envs/staging/.env.app", ["PORT=3000"]),
+                (".envs/prod/.env.app", ["PORT=9000", "SECRET=prod-exclusive-secret"]),
+            ],
+            id="multi_env_nested",
+        ),
+        # Files at root
+        pytest.param(
+            "flat",
+            ["staging"],
+            [
+                (".env.app", ["PORT=3000"]),
+                (".env.database", ["DB_URL=postgres://db:5432"]),
+            ],
+            id="flat_staging",
+        ),
+        # All in one .env file, without the generator's own settings
+        pytest.param(
+            "single",
+            ["prod"],
+            [
+                (
+                    ".env",
+                    [
+                        "APP_PORT=9000",
+                        "DATABASE_DB_USER=prod-json-admin",
+                        "REDIS_HOST=redis-prod-yaml-cluster",
+                    ],
+                    ["FILES_GENERATE", "FILES_STRUCTURE", "FILES_FORMAT"],
+                )
+            ],
+            id="single_prod",
+        ),
+        # Auto on empty dir defaults to nested-like logic
+        pytest.param("auto", ["dev"], [(".envs/dev/.env.app", ["PORT=8000"])], id="auto_dev"),
+    ],
+)
+def test_env_exhaustive_structure(
+    integration_conn, clean_remote_dir, structure, environments, expected
+):
     """
-    1. Structure: NESTED
-    2. Environments: DEV, STAGING, PROD (Coexistence)
-    3. Formats: Standard .env blobs
+    Each ENV_FILES_STRUCTURE rendered for one or more environments; expected paths are
+    relative to the target dir.
     """
-    target_dir = clean_remote_dir("multi_env_nested")
-    monkeypatch.setattr(config, "ENV_FILES_GENERATE", True)
-    monkeypatch.setattr(config, "ENV_FILES_STRUCTURE", "nested")
-    monkeypatch.setattr(config, "GIT_SUBDIR", target_dir)
-
-    for env in ["dev", "staging", "prod"]:
-        monkeypatch.setattr(config, "ENVIRONMENT", env)
-        generate_env_files(integration_conn)
-
-    # Assert dev structure
-    assert_file_content(integration_conn, f"{target_dir}/.envs/dev/.env.app", ["PORT=8000"])
-    # Assert staging structure
-    assert_file_content(integration_conn, f"{target_dir}/.envs/staging/.env.app", ["PORT=3000"])
-    # Assert prod structure
-    assert_file_content(
-        integration_conn,
-        f"{target_dir}/.envs/prod/.env.app",
-        ["PORT=9000", "SECRET=prod-exclusive-secret"],
+    target_dir = clean_remote_dir(f"structure_{structure}_{'_'.join(environments)}")
+
+    def render(env):
+        # Every environment writes its own files, so they're rendered concurrently; like
+        # the multi-host workers, each thread gets its own bound config
+        with config.bind({"ENVIRONMENT": env}):
+            config.ENV_FILES_GENERATE = True
+            config.ENV_FILES_STRUCTURE = structure
+            config.GIT_SUBDIR = target_dir
+            generate_env_files(integration_conn)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(environments)) as executor:
+        list(executor.map(render, environments))
+
+    assert_files_content(
+        integration_conn, [(f"{target_dir}/{path}", *checks) for path, *checks in expected]
     )
 
 
-@pytest.mark.integration
-def test_env_exhaustive_flat_staging(integration_conn, clean_remote_dir, monkeypatch):
-    """
-    1. Structure: FLAT
-    2. Environment: STAGING
-    3. Behavior: Files at root
-    """
-    target_dir = clean_remote_dir("flat_staging")
-    monkeypatch.setattr(config, "ENV_FILES_GENERATE", True)
-    monkeypatch.setattr(config, "ENV_FILES_STRUCTURE", "flat")
-    monkeypatch.setattr(config, "ENVIRONMENT", "staging")
-    monkeypatch.setattr(config, "GIT_SUBDIR", target_dir)
-
-    generate_env_files(integration_conn)
-
-    assert_file_content(integration_conn, f"{target_dir}/.env.app", ["PORT=3000"])
-    assert_file_content(
-        integration_conn, f"{target_dir}/.env.database", ["DB_URL=postgres://db:5432"]
-    )
-
-
-@pytest.mark.integration
-def test_env_exhaustive_single_prod(integration_conn, clean_remote_dir, monkeypatch):
-    """
-    1. Structure: SINGLE
-    2. Environment: PROD
-    3. Behavior: All in one .env file
-    """
-    target_dir = clean_remote_dir("single_prod")
-    monkeypatch.setattr(config, "ENV_FILES_GENERATE", True)
-    monkeypatch.setattr(config, "ENV_FILES_STRUCTURE", "single")
-    monkeypatch.setattr(config, "ENVIRONMENT", "prod")
-    monkeypatch.setattr(config, "GIT_SUBDIR", target_dir)
-
-    generate_env_files(integration_conn)
-
-    assert_file_content(
-        integration_conn,
-        f"{target_dir}/.env",
-        ["APP_PORT=9000", "DATABASE_DB_USER=prod-json-admin", "REDIS_HOST=redis-prod-yaml-cluster"],
-        forbidden_substrings=["FILES_GENERATE", "FILES_STRUCTURE", "FILES_FORMAT"],
-    )
-
-
-@pytest.mark.integration
-def test_env_exhaustive_auto_dev(integration_conn, clean_remote_dir, monkeypatch):
-    """
-    1. Structure: AUTO (should behave like nested if multiple folders exist)
-    2. Environment: DEV
-    """
-    target_dir = clean_remote_dir("auto_dev")
-    monkeypatch.setattr(config, "ENV_FILES_GENERATE", True)
-    monkeypatch.setattr(config, "ENV_FILES_STRUCTURE", "auto")
-    monkeypatch.setattr(config, "ENVIRONMENT", "dev")
-    monkeypatch.setattr(config, "GIT_SUBDIR", target_dir)
-
-    generate_env_files(integration_conn)
-
-    # Auto on empty dir defaults to nested-like logic
-    assert_file_content(integration_conn, f"{target_dir}/.envs/dev/.env.app", ["PORT=8000"])
-
-
 @pytest.mark.integration
 def test_env_exhaustive_custom_path_relative(integration_conn, clean_remote_dir, monkeypatch):
     """
@@ -243,8 +268,7 @@ def test_env_exhaustive_custom_path_absolute(integration_conn, clean_remote_dir,
     """
     1. Path: Custom Absolute (/tmp/metaldeploy_abs)
     """
-    clean_remote_dir("custom_path_abs")
-    abs_path = "/opt/metaldeploy_tests/custom_path_abs"
+    abs_path = clean_remote_dir("custom_path_abs", extra_mkdirs=["/tmp/random_cwd_for_abs_test"])
     # No need to recreate abs_path since clean_remote_dir already did it
 
     monkeypatch.setattr(config, "ENV_FILES_GENERATE", True)
@@ -252,7 +276,6 @@ def test_env_exhaustive_custom_path_absolute(integration_conn, clean_remote_dir,
     monkeypatch.setattr(config, "ENV_FILES_PATH", abs_path)
     monkeypatch.setattr(config, "ENVIRONMENT", "dev")
     monkeypatch.setattr(config, "GIT_SUBDIR", "/tmp/random_cwd_for_abs_test")
-    integration_conn.run("mkdir -p /tmp/random_cwd_for_abs_test")
 
     generate_env_files(integration_conn)
 
@@ -272,13 +295,14 @@ def test_env_exhaustive_json_yaml_formats(integration_conn, clean_remote_dir, mo
 
     generate_env_files(integration_conn)
 
-    # DATABASE was JSON in .env.test
-    assert_file_content(
-        integration_conn, f"{target_dir}/.env.database", ["DB_USER=prod-json-admin"]
-    )
-    # REDIS was YAML in .env.test
-    assert_file_content(
-        integration_conn, f"{target_dir}/.env.redis", ["HOST=redis-prod-yaml-cluster"]
+    assert_files_content(
+        integration_conn,
+        [
+            # DATABASE was JSON in .env.test
+            (f"{target_dir}/.env.database", ["DB_USER=prod-json-admin"]),
+            # REDIS was YAML in .env.test
+            (f"{target_dir}/.env.redis", ["HOST=redis-prod-yaml-cluster"]),
+        ],
     )
 
 
@@ -297,12 +321,16 @@ def test_env_exhaustive_create_root_aggregated(integration_conn, clean_remote_di
     generate_env_files(integration_conn)
 
     # Both nested and root combined file should exist
-    assert_file_content(integration_conn, f"{target_dir}/.envs/dev/.env.app", ["PORT=8000"])
-    assert_file_content(
+    assert_files_content(
         integration_conn,
-        f"{target_dir}/.env",
-        ["APP_PORT=8000", "DATABASE_DB_USER=json-admin"],
-        forbidden_substrings=["FILES_GENERATE", "FILES_STRUCTURE", "FILES_FORMAT"],
+        [
+            (f"{target_dir}/.envs/dev/.env.app", ["PORT=8000"]),
+            (
+                f"{target_dir}/.env",
+                ["APP_PORT=8000", "DATABASE_DB_USER=json-admin"],
+                ["FILES_GENERATE", "FILES_STRUCTURE", "FILES_FORMAT"],
+            ),
+        ],
     )
 
 
@@ -324,57 +352,48 @@ def test_env_exhaustive_explicit_patterns(integration_conn, clean_remote_dir, mo
 
     generate_env_files(integration_conn)
 
-    assert_file_content(integration_conn, f"{target_dir}/.env.only_app", ["VAR=app_val"])
-    assert_file_content(integration_conn, f"{target_dir}/.env.only_db", ["VAR=db_val"])
+    assert_files_content(
+        integration_conn,
+        [
+            (f"{target_dir}/.env.only_app", ["VAR=app_val"]),
+            (f"{target_dir}/.env.only_db", ["VAR=db_val"]),
+        ],
+    )
 
 
 @pytest.mark.integration
-def test_env_exhaustive_file_path_secret(integration_conn, clean_remote_dir, monkeypatch, tmp_path):
+def test_env_exhaustive_file_path_secret(
+    integration_conn, clean_remote_dir, monkeypatch, artifact_corpus
+):
     """
     Verify reading secrets from a file path (Jenkins/CI style).
     """
     target_dir = clean_remote_dir("file_path_secret")
 
-    # Create a local secret file
-    secret_file = tmp_path / "jenkins_secret.json"
-    secret_content = '{"FILE_DB_USER": "file-user-admin", "FILE_DB_PASS": "file-secret-pass"}'
-    secret_file.write_text(secret_content)
-
     monkeypatch.setattr(config, "ENV_FILES_GENERATE", True)
     monkeypatch.setattr(config, "ENV_FILES_STRUCTURE", "flat")
     monkeypatch.setattr(config, "ENVIRONMENT", "dev")
     monkeypatch.setattr(config, "GIT_SUBDIR", target_dir)
 
-    # Point the environment variable to the local file path
-    monkeypatch.setenv("ENV_DATABASE", str(secret_file))
+    # Point the environment variables to local file paths (session corpus), one per
+    # format, so a single generation covers all three
+    monkeypatch.setenv("ENV_DATABASE", str(artifact_corpus / "jenkins_secret.json"))
+    monkeypatch.setenv("ENV_REDIS", str(artifact_corpus / "jenkins_secret.yaml"))
+    monkeypatch.setenv("ENV_S3", str(artifact_corpus / "jenkins_secret.env"))
 
     generate_env_files(integration_conn)
 
-    # Verify JSON from file
-    assert_file_content(
+    assert_files_content(
         integration_conn,
-        f"{target_dir}/.env.database",
-        ["DB_USER=file-user-admin", "DB_PASS=file-secret-pass"],
-    )
-
-    # 2. Test YAML from file
-    yaml_file = tmp_path / "jenkins_secret.yaml"
-    yaml_file.write_text("HOST: yaml-file-host\nPORT: 6379")
-    monkeypatch.setenv("ENV_REDIS", str(yaml_file))
-
-    # 3. Test standard .env from file
-    env_file = tmp_path / "jenkins_secret.env"
-    env_file.write_text("S3_BUCKET=file-bucket\nS3_REGION=us-east-1")
-    monkeypatch.setenv("ENV_S3", str(env_file))
-
-    generate_env_files(integration_conn)
-
-    # Verify YAML from file
-    assert_file_content(
-        integration_conn, f"{target_dir}/.env.redis", ["HOST=yaml-file-host", "PORT=6379"]
-    )
-
-    # Verify .env from file
-    assert_file_content(
-        integration_conn, f"{target_dir}/.env.s3", ["BUCKET=file-bucket", "REGION=us-east-1"]
+        [
+            # Verify JSON from file
+            (
+                f"{target_dir}/.env.database",
+                ["DB_USER=file-user-admin", "DB_PASS=file-secret-pass"],
+            ),
+            # Verify YAML from file
+            (f"{target_dir}/.env.redis", ["HOST=yaml-file-host", "PORT=6379"]),
+            # Verify .env from file
+            (f"{target_dir}/.env.s3", ["BUCKET=file-bucket", "REGION=us-east-1"]),
+        ],
     )
@@ -0,0 +1,16 @@
+from contextlib import nullcontext
+from unittest.mock import Mock
+
+import pytest
+from fabric import Connection
+
+
+@pytest.fixture
+def mock_conn():
+    """Connection double whose run() succeeds with empty output"""
+    # Test files needing another double (MagicMock, canned stdout) override this fixture
+    conn = Mock(spec=Connection)
+    conn.run.return_value = Mock(stdout="", ok=True)
+    # A real (reusable) no-op context manager for `with conn.cd(...)`
+    conn.cd.return_value = nullcontext()
+    return conn
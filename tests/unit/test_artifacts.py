@@ -1,6 +1,7 @@
 from unittest.mock import MagicMock, patch
 
 import pytest
+from fabric import Connection
 
 from src import config
 from src.connection import copy_artifacts
@@ -8,11 +9,18 @@ from src.connection import copy_artifacts
 
 @pytest.fixture
 def mock_conn():
-    conn = MagicMock()
+    conn = MagicMock(spec=Connection)
     conn.run.return_value = MagicMock(ok=True, stdout="")
     return conn
 
 
+@pytest.fixture
+def mock_sftp():
+    """The SFTP client copy_artifacts uploads through"""
+    with patch("src.connection.open_sftp") as mock_open_sftp:
+        yield mock_open_sftp.return_value
+
+
 def test_copy_artifacts_no_config(mock_conn, monkeypatch):
     monkeypatch.setattr(config, "COPY_ARTIFACTS", [])
     copy_artifacts(mock_conn)
@@ -26,7 +34,7 @@ def test_copy_artifacts_local_missing(mock_conn, monkeypatch, capsys):
     assert "not found, skipping" in capsys.readouterr().out
 
 
-def test_copy_artifacts_success(mock_conn, monkeypatch, tmp_path):
+def test_copy_artifacts_success(mock_conn, mock_sftp, monkeypatch, tmp_path):
     # Create a dummy local file
     local_file = tmp_path / "test.txt"
     local_file.write_text("content")
@@ -46,12 +54,160 @@ def test_copy_artifacts_success(mock_conn, monkeypatch, tmp_path):
         # Verify tarball creation
         mock_tar.add.assert_called_with(str(local_file), arcname="test.txt")
 
-        # Verify upload
-        assert mock_conn.put.called
+        # Verify upload, and that the session is closed afterwards
+        assert mock_sftp.put.called
+        mock_sftp.close.assert_called_once()
 
         # Verify extraction logic runs
-        calls = [str(c) for c in mock_run_cmd.mock_calls]
+        calls = [c[0][1] for c in mock_run_cmd.call_args_list]
         assert any("mkdir -p /app" in c for c in calls)
         assert any("rm -rf /app/test.txt" in c for c in calls)
         assert any("tar -xzf" in c and "-C /app" in c for c in calls)
         assert any("rm /tmp/" in c for c in calls)
+
+
+def test_open_sftp_uses_large_window():
+    from fabric import Connection
+
+    from src.connection import SFTP_WINDOW_SIZE, open_sftp
+
+    conn = Connection("example.invalid")
+    with patch.object(Connection, "open"), patch.object(
+        Connection, "transport", create=True
+    ), patch("paramiko.SFTPClient.from_transport") as mock_from_transport:
+        sftp = open_sftp(conn)
+        # Fabric's own cached client is left untouched
+        assert conn._sftp is None
+
+    assert sftp is mock_from_transport.return_value
+    mock_from_transport.assert_called_once()
+    assert mock_from_transport.call_args[1]["window_size"] == SFTP_WINDOW_SIZE
+
+
+def test_copy_artifacts_skips_unchanged(mock_conn, mock_sftp, monkeypatch, tmp_path):
+    from src.connection import _artifact_digest
+
+    same = tmp_path / "same.txt"
+    same.write_text("unchanged")
+    changed = tmp_path / "dist"
+    changed.mkdir()
+    (changed / "app.js").write_text("new build")
+
+    monkeypatch.setattr(
+        config,
+        "COPY_ARTIFACTS",
+        [(str(same), "/app/same.txt"), (str(changed), "/app/dist")],
+    )
+    # Remote has the current digest for same.txt and a stale one for dist
+    mock_conn.run.return_value = MagicMock(stdout=f"0 {_artifact_digest(str(same))}\n1 stale\n")
+
+    with patch("src.connection.run_command") as mock_run_cmd:
+        copy_artifacts(mock_conn)
+
+    # Both targets checked in a single remote call, the new digest recorded in another
+    assert mock_conn.run.call_count == 2
+    assert mock_sftp.put.call_count == 1
+    mock_run_cmd.assert_called_once()
+    assert "rm -rf /app/dist && tar -xzf" in mock_run_cmd.call_args[0][1]
+    record_cmd = mock_conn.run.call_args[0][0]
+    assert _artifact_digest(str(changed)) in record_cmd
+    assert _artifact_digest(str(same)) not in record_cmd
+
+
+def test_copy_artifacts_digests_matched_by_index(mock_conn, mock_sftp, monkeypatch, tmp_path):
+    """An empty or malformed record can't shift the digests of the following artifacts"""
+    import subprocess
+
+    from src.connection import _artifact_digest, _artifact_marker
+
+    artifacts = []
+    for name in ("first.txt", "second.txt"):
+        (tmp_path / name).write_text(name)
+        (tmp_path / "remote" / name).mkdir(parents=True)
+        artifacts.append((str(tmp_path / name), str(tmp_path / "remote" / name)))
+    monkeypatch.setattr(config, "COPY_ARTIFACTS", artifacts)
+    monkeypatch.setattr("src.connection.ARTIFACT_MARKER_DIR", str(tmp_path / "markers"))
+    (tmp_path / "markers").mkdir()
+    # The first record is empty, the second one is current
+    open(_artifact_marker(artifacts[0][1]), "w").close()
+    with open(_artifact_marker(artifacts[1][1]), "w") as f:
+        f.write(_artifact_digest(artifacts[1][0]) + "\n")
+
+    def run_locally(cmd, **kwargs):
+        out = subprocess.run(["bash", "-c", cmd], capture_output=True, text=True)
+        return MagicMock(stdout=out.stdout, ok=out.returncode == 0)
+
+    mock_conn.run.side_effect = run_locally
+    with patch("src.connection.run_command") as mock_run_cmd:
+        copy_artifacts(mock_conn)
+
+    # Only the first artifact is uploaded, and its digest is recorded afterwards
+    mock_sftp.put.assert_called_once()
+    assert "first.txt" in mock_run_cmd.call_args[0][1]
+    with open(_artifact_marker(artifacts[0][1])) as f:
+        assert f.read().strip() == _artifact_digest(artifacts[0][0])
+    assert oct((tmp_path / "markers").stat().st_mode)[-3:] == "700"
+
+
+def test_copy_artifacts_failed_extract_not_recorded(mock_conn, mock_sftp, monkeypatch, tmp_path):
+    """A failed extraction propagates and leaves no digest record behind"""
+    from invoke import Result
+    from invoke.exceptions import UnexpectedExit
+
+    local_file = tmp_path / "test.txt"
+    local_file.write_text("content")
+    monkeypatch.setattr(config, "COPY_ARTIFACTS", [(str(local_file), "/app/test.txt")])
+
+    failure = UnexpectedExit(Result(command="tar -xzf", exited=2))
+    with patch("src.connection.run_command", side_effect=failure):
+        with pytest.raises(UnexpectedExit):
+            copy_artifacts(mock_conn)
+
+    # Only the digest check ran; nothing was recorded, and the session was still closed
+    mock_conn.run.assert_called_once()
+    mock_sftp.close.assert_called_once()
+
+
+def test_artifact_digest_tracks_directory_content(tmp_path):
+    from src.connection import _artifact_digest
+
+    (tmp_path / "a.txt").write_text("1")
+    before = _artifact_digest(str(tmp_path))
+    assert _artifact_digest(str(tmp_path)) == before
+    (tmp_path / "a.txt").write_text("2")
+    assert _artifact_digest(str(tmp_path)) != before
+
+
+def test_artifact_digest_tracks_modes_and_symlinks(tmp_path):
+    from src.connection import _artifact_digest
+
+    art = tmp_path / "dist"
+    art.mkdir()
+    (art / "run.sh").write_text("echo hi")
+    (tmp_path / "v1").mkdir()
+    (tmp_path / "v2").mkdir()
+    (art / "current").symlink_to(tmp_path / "v1")
+    before = _artifact_digest(str(art))
+
+    (art / "run.sh").chmod(0o755)
+    after_chmod = _artifact_digest(str(art))
+    assert after_chmod != before
+
+    # A symlinked dir isn't walked into, but retargeting it still changes the digest
+    (art / "current").unlink()
+    (art / "current").symlink_to(tmp_path / "v2")
+    assert _artifact_digest(str(art)) != after_chmod
+
+
+def test_copy_artifacts_unchanged_skips_sftp(mock_conn, monkeypatch, tmp_path):
+    from src.connection import _artifact_digest
+
+    same = tmp_path / "same.txt"
+    same.write_text("unchanged")
+    monkeypatch.setattr(config, "COPY_ARTIFACTS", [(str(same), "/app/same.txt")])
+    mock_conn.run.return_value = MagicMock(stdout=f"0 {_artifact_digest(str(same))}\n")
+
+    with patch("src.connection.open_sftp") as mock_open_sftp:
+        copy_artifacts(mock_conn)
+
+    mock_open_sftp.assert_not_called()
@@ -1,77 +1,277 @@
+import subprocess
 from unittest.mock import Mock, patch
 
 import pytest
-from fabric import Connection
 
 from src.config import config
 from src.providers import utils
 
 
-@pytest.fixture
-def mock_conn():
-    conn = Mock(spec=Connection)
-    conn.run.return_value = Mock(stdout="", ok=True)
-    conn.cd.return_value.__enter__ = Mock(return_value=None)
-    conn.cd.return_value.__exit__ = Mock(return_value=None)
-    return conn
+def probe_output(files=None, k8s=None):
+    """stdout of the detection probe for the given {compose_file: content}"""
+    out = "".join(
+        f"@@metaldeploy:file:{name}\n{content}\n" for name, content in (files or {}).items()
+    )
+    if k8s is not None:
+        out += f"@@metaldeploy:k8s\n{k8s}"
+    return Mock(stdout=out)
+
+
+def run_in_shell(cwd=None, outputs=None):
+    """conn.run side_effect executing commands in a local bash (stdout kept in outputs)"""
+
+    def run(cmd, **kwargs):
+        out = subprocess.run(["bash", "-c", cmd], cwd=cwd, capture_output=True, text=True)
+        if outputs is not None:
+            outputs.append(out.stdout)
+        return Mock(stdout=out.stdout, ok=out.returncode == 0)
+
+    return run
+
+
+POSTGRES_COMPOSE = """services:
+  db:
+    image: postgres:16
+    volumes:
+      - ./data/postgres:/var/lib/postgresql/data
+      - postgres_named:/var/lib/postgresql
+"""
 
 
 def test_detect_db_postgres(mock_conn, monkeypatch):
     monkeypatch.setattr(config, "GIT_SUBDIR", "/app")
+    mock_conn.run.return_value = probe_output({"docker-compose.yml": POSTGRES_COMPOSE})
 
-    def mock_run(cmd, **kwargs):
-        if "test -f" in cmd:
-            if "docker-compose.yml" in cmd:
-                return Mock(stdout="exists")
-            return Mock(stdout="not exists")
-        if "grep" in cmd:
-            if "postgres" in cmd:
-                return Mock(stdout="image: postgres")
-            return Mock(stdout="")
-        return Mock(stdout="")
-
-    mock_conn.run.side_effect = mock_run
     dbs = utils.detect_database_type(mock_conn)
-    assert "postgres" in dbs
+    assert dbs == ["postgres"]
+    # All compose files are read in a single remote call
+    assert mock_conn.run.call_count == 1
+    assert mock_conn.run.call_args[0][0].startswith("cd /app && ")
+    mock_conn.cd.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "subdir,expected",
+    [
+        ("~/x", "cd ~/x && "),
+        ("~/my app", "cd ~/'my app' && "),
+        ("~", "cd ~ && "),
+        ("/srv/my app", "cd '/srv/my app' && "),
+    ],
+)
+def test_probe_cd_keeps_tilde(mock_conn, monkeypatch, subdir, expected):
+    monkeypatch.setattr(config, "GIT_SUBDIR", subdir)
+    mock_conn.run.return_value = probe_output()
+
+    utils.detect_database_type(mock_conn)
+    assert mock_conn.run.call_args[0][0].startswith(expected)
+
+
+def test_probe_cd_expands_tilde(mock_conn, monkeypatch, tmp_path):
+    """A ~-based GIT_SUBDIR is entered for real, not skipped by a failed cd"""
+    (tmp_path / "x").mkdir()
+    (tmp_path / "x" / "compose.yml").write_text("services:\n  db:\n    image: postgres\n")
+    monkeypatch.setattr(config, "GIT_SUBDIR", "~/x")
+    monkeypatch.setenv("HOME", str(tmp_path))
+
+    mock_conn.run.side_effect = run_in_shell()
+    assert utils.detect_database_type(mock_conn) == ["postgres"]
 
 
 def test_detect_db_multiple(mock_conn, monkeypatch):
     monkeypatch.setattr(config, "GIT_SUBDIR", "/app")
+    mock_conn.run.return_value = probe_output(
+        {"compose.yml": "services:\n  db:\n    image: postgres\n  cache:\n    image: REDIS\n"}
+    )
 
-    def mock_run(cmd, **kwargs):
-        if "test -f" in cmd:
-            if "docker-compose.yml" in cmd:
-                return Mock(stdout="exists")
-            return Mock(stdout="not exists")
-        if "grep" in cmd:
-            if "postgres" in cmd or "redis" in cmd:
-                return Mock(stdout="match")
-            return Mock(stdout="")
-        return Mock(stdout="")
-
-    mock_conn.run.side_effect = mock_run
     dbs = utils.detect_database_type(mock_conn)
-    assert "postgres" in dbs
-    assert "redis" in dbs
+    assert dbs == ["postgres", "redis"]
 
 
-def test_fix_permissions_logic(mock_conn, monkeypatch):
+def test_detect_db_script_against_files(mock_conn, monkeypatch, tmp_path):
+    """Run the generated probe in a real shell over sample compose/manifest files"""
+    monkeypatch.setattr(config, "GIT_SUBDIR", str(tmp_path))
+    monkeypatch.setattr(config, "DEPLOYMENT_TYPE", "k8s")
+    (tmp_path / "compose.yaml").write_text(
+        "services:\n  db:\n    image: postgresql:16\n  cache:\n    image: Redis:7\n"
+    )
+    (tmp_path / "k8s").mkdir()
+    (tmp_path / "k8s" / "mongo.yaml").write_text("image: mongodb:7\n")
+
+    mock_conn.run.side_effect = run_in_shell(tmp_path)
+    assert utils.detect_database_type(mock_conn) == ["postgres", "mongodb", "redis"]
+
+
+def test_k8s_probe_prints_each_database_once(mock_conn, monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "GIT_SUBDIR", str(tmp_path))
+    monkeypatch.setattr(config, "DEPLOYMENT_TYPE", "k8s")
+    (tmp_path / "manifests").mkdir()
+    for i in range(3):
+        (tmp_path / "manifests" / f"{i}.yaml").write_text(
+            "image: REDIS\nimage: redis\nimage: postgres\nmysql mariadb mongo\n" * 50
+        )
+    outputs = []
+    mock_conn.run.side_effect = run_in_shell(outputs=outputs)
+    assert len(utils.detect_database_type(mock_conn)) == 5
+    k8s_section = outputs[0].split("@@metaldeploy:k8s\n")[1].split("@@metaldeploy:")[0]
+    assert sorted(k8s_section.split()) == ["mariadb", "mongo", "mysql", "postgres", "redis"]
+
+
+def test_volume_paths_from_compose_yaml(mock_conn, monkeypatch):
     monkeypatch.setattr(config, "GIT_SUBDIR", "/app")
+    compose = """services:
+  db:
+    image: postgres
+    volumes:
+      - ./data/postgres:/var/lib/postgresql/data
+      - type: bind
+        source: /srv/postgres-wal
+        target: /var/lib/postgresql/wal
+      - ./data/postgres:/var/lib/postgresql/data
+#     - ./data/postgres-old:/var/lib/postgresql/data
+"""
+    mock_conn.run.return_value = probe_output({"compose.yaml": compose})
+
+    assert utils.get_database_volume_paths(mock_conn, "postgres") == [
+        "./data/postgres",
+        "/srv/postgres-wal",
+    ]
+    mock_conn.run.assert_called_once()
 
-    def mock_run(cmd, **kwargs):
-        if "test -f" in cmd:
-            return Mock(stdout="exists")
-        if "grep" in cmd:
-            return Mock(stdout="postgres")
-        if "find" in cmd:
-            return Mock(stdout="./pgdata")
-        return Mock(stdout="")
 
-    mock_conn.run.side_effect = mock_run
+def test_volume_paths_fallback_for_invalid_yaml(mock_conn, monkeypatch):
+    monkeypatch.setattr(config, "GIT_SUBDIR", "/app")
+    compose = "services:\n  db:\n    volumes:\n      - ./data/mysql:/var/lib/mysql\n  bad: [\n"
+    mock_conn.run.return_value = probe_output({"compose.yaml": compose})
+
+    assert utils.get_database_volume_paths(mock_conn, "mysql") == ["./data/mysql"]
+
+
+def test_fix_permissions_logic(mock_conn, monkeypatch):
+    monkeypatch.setattr(config, "GIT_SUBDIR", "/app")
+    probe = probe_output({"docker-compose.yml": POSTGRES_COMPOSE + "  cache:\n    image: redis\n"})
+    probe.stdout += "@@metaldeploy:dirs\n./volumes/postgres-old\n./data/mysql\n"
+    mock_conn.run.return_value = probe
 
     with patch("src.providers.utils.run_command") as mock_run_cmd:
         utils.fix_database_permissions(mock_conn)
         assert mock_run_cmd.called
         args = mock_run_cmd.call_args[0][1]
         assert "chown -R 999:999" in args
-        assert "./pgdata" in args
+        assert "./volumes/postgres-old" in args
+        assert "./data/postgres" in args
+        # mysql wasn't detected, so its directory is left alone
+        assert "mysql" not in args
+
+    # Compose files, manifests and data dirs all come from the one detection probe
+    mock_conn.run.assert_called_once()
+    probe_cmd = mock_conn.run.call_args[0][0]
+    assert "*postgres*" in probe_cmd and "*redis*" in probe_cmd
+
+
+def test_fix_permissions_cd_outside_sudo(mock_conn, monkeypatch):
+    """The fix runs from GIT_SUBDIR entered by the deploy user, so ~ isn't root's home"""
+    from contextlib import contextmanager
+
+    monkeypatch.setattr(config, "GIT_SUBDIR", "~/x")
+    monkeypatch.setattr(config, "USE_SUDO", True)
+    monkeypatch.setattr(config, "REMOTE_PASSWORD", None)
+    cwd = []
+
+    @contextmanager
+    def cd(path):
+        cwd.append(path)
+        yield
+        cwd.pop()
+
+    def run(cmd, **kwargs):
+        if cmd.startswith("sudo "):
+            # Inside the sudo wrapper nothing changes directory again
+            assert cwd == ["~/x"] and "cd " not in cmd
+            return Mock(stdout="", ok=True)
+        return probe_output({"compose.yml": POSTGRES_COMPOSE})
+
+    mock_conn.cd.side_effect = cd
+    mock_conn.run.side_effect = run
+    utils.fix_database_permissions(mock_conn)
+    assert any(c[0][0].startswith("sudo ") for c in mock_conn.run.call_args_list)
+
+
+def test_existing_data_dirs_find(mock_conn, monkeypatch, tmp_path):
+    """The data-dir find matches data/volumes dirs and never descends into .git"""
+    for d in ["data/postgres", "volumes/postgres-1", "postgres", ".git/data/postgres"]:
+        (tmp_path / d).mkdir(parents=True)
+    monkeypatch.setattr(config, "GIT_SUBDIR", str(tmp_path))
+    (tmp_path / "compose.yml").write_text("services:\n  db:\n    image: postgres\n")
+
+    mock_conn.run.side_effect = run_in_shell(tmp_path)
+    with patch("src.providers.utils.run_command") as mock_run_cmd:
+        utils.fix_database_permissions(mock_conn)
+    fixed = " ".join(c[0][1] for c in mock_run_cmd.call_args_list)
+    assert "./data/postgres" in fixed
+    assert "./volumes/postgres-1" in fixed
+    assert ".git" not in fixed
+    # One probe finds everything and all paths are fixed in a single exec
+    mock_conn.run.assert_called_once()
+    mock_run_cmd.assert_called_once()
+
+    # run_command executes under set -e; a failing chown must not stop the other steps
+    cmd = "set -e; " + mock_run_cmd.call_args[0][1].replace("chown -R 999:999", "false")
+    assert subprocess.run(["bash", "-c", cmd], cwd=tmp_path).returncode == 0
+    assert oct((tmp_path / "volumes/postgres-1").stat().st_mode)[-3:] == "700"
+
+
+def test_data_dirs_capped_per_database(tmp_path):
+    """A database with many data dirs can't use up the other databases' share"""
+    for i in range(60):
+        (tmp_path / "data" / f"postgres-{i}").mkdir(parents=True)
+    (tmp_path / "volumes" / "redis").mkdir(parents=True)
+    names = [dir_name for dir_name, *_ in utils.DB_PERMISSIONS.values()]
+
+    out = subprocess.run(
+        ["bash", "-c", utils._data_dirs_find(names)],
+        cwd=tmp_path,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    assert "./volumes/redis" in out
+    assert len([d for d in out if "postgres" in d]) == utils.MAX_DATA_DIRS
+
+
+def test_detection_cached_per_connection(mock_conn, monkeypatch):
+    monkeypatch.setattr(config, "GIT_SUBDIR", "/app")
+    mock_conn.run.return_value = probe_output({"compose.yaml": POSTGRES_COMPOSE})
+
+    assert utils.detect_database_type(mock_conn) == ["postgres"]
+    assert utils.detect_database_type(mock_conn) == ["postgres"]
+    # Volume extraction reuses the compose files read during detection
+    assert utils.get_database_volume_paths(mock_conn, "postgres") == ["./data/postgres"]
+    assert mock_conn.run.call_count == 1
+
+    # A new connection (here: a dropped cache entry) probes again
+    utils._DETECT_CACHE.clear()
+    utils.detect_database_type(mock_conn)
+    assert mock_conn.run.call_count == 2
+
+
+def test_volume_paths_skipped_without_compose_files(mock_conn, monkeypatch):
+    monkeypatch.setattr(config, "GIT_SUBDIR", "/app")
+    monkeypatch.setattr(config, "DEPLOYMENT_TYPE", "k8s")
+    mock_conn.run.return_value = probe_output(k8s="redis\n")
+
+    assert utils.detect_database_type(mock_conn) == ["redis"]
+    assert utils.get_database_volume_paths(mock_conn, "redis") == []
+    assert mock_conn.run.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "output,expected",
+    [
+        ("  - ./data/pg:/var/lib/postgresql", ["./data/pg"]),
+        ("- /srv/db :/data\n  - named:/data\n", ["/srv/db"]),
+        ("./a:/x:/y\n--./b:/z\n- - ./c:/z", ["./a", "./b"]),
+        ("", []),
+    ],
+)
+def test_parse_volume_paths(output, expected):
+    assert utils._parse_volume_paths(output) == expected
@@ -39,3 +39,11 @@ def test_detect_patterns_ignore_config():
     # Should default to .env.app if nothing else found, or empty?
     # Logic returns [".env.app"] if patterns is empty.
     assert patterns == [".env.app"]
+
+
+def test_detect_patterns_cached_by_names():
+    """Same variable names reuse one detection; callers get their own list."""
+    first = detect_file_patterns({"ENV_REDIS": "a", "ENV_APP": "b"}, "auto", "dev")
+    first.append(".env.extra")
+    second = detect_file_patterns({"ENV_APP": "c", "ENV_REDIS": "d"}, "nested", "dev")
+    assert second == [".env.app", ".env.redis"]
@@ -1,33 +1,56 @@
 import os
-from unittest.mock import Mock, patch
+import subprocess
+from unittest.mock import patch
 
 import pytest
-from fabric import Connection
 
 from src.config import config
 from src.env_manager import (
     create_env_file,
+    create_env_files,
     detect_environment_secrets,
     detect_file_patterns,
     determine_file_structure,
     generate_env_files,
+    merge_env_vars_by_priority,
     parse_all_in_one_secret,
 )
 
 
-@pytest.fixture
-def mock_conn():
-    conn = Mock(spec=Connection)
-    conn.run.return_value = Mock(stdout="", ok=True)
-    conn.cd.return_value.__enter__ = Mock(return_value=None)
-    conn.cd.return_value.__exit__ = Mock(return_value=None)
-    return conn
+@pytest.mark.parametrize(
+    "fmt,content,expected",
+    [
+        ("env", "K1=V1\nK2=V2", {"K1": "V1", "K2": "V2"}),
+        ("json", '{"K1": "V1"}', {"K1": "V1"}),
+        # Accepted by the stdlib decoder even where orjson is stricter
+        (
+            "json",
+            '{"BIG": 18446744073709551616, "R": NaN}',
+            {"BIG": "18446744073709551616", "R": "nan"},
+        ),
+        ("yaml", "K1: V1", {"K1": "V1"}),
+        # An explicit hint whose shape doesn't match the content yields nothing
+        ("json", "K1=V1", {}),
+        ("yaml", "K1=V1", {}),
+    ],
+)
+def test_parse_formats(fmt, content, expected):
+    assert parse_all_in_one_secret(content, fmt) == expected
+
+
+def test_parse_auto_env_blob_with_colons():
+    content = "URL=https://app.com:8443\nMSG=hello: world"
+    assert parse_all_in_one_secret(content) == {
+        "URL": "https://app.com:8443",
+        "MSG": "hello: world",
+    }
+    assert parse_all_in_one_secret("HOST: redis\nPORT: 6379") == {"HOST": "redis", "PORT": "6379"}
 
 
-def test_parse_formats():
-    assert parse_all_in_one_secret("K1=V1\nK2=V2", "env") == {"K1": "V1", "K2": "V2"}
-    assert parse_all_in_one_secret('{"K1": "V1"}', "json") == {"K1": "V1"}
-    assert parse_all_in_one_secret("K1: V1", "yaml") == {"K1": "V1"}
+def test_parse_cached_result_is_copied():
+    first = parse_all_in_one_secret("K1=V1", "env")
+    first["K2"] = "mutated"
+    assert parse_all_in_one_secret("K1=V1", "env") == {"K1": "V1"}
 
 
 def test_pattern_detection():
@@ -55,27 +78,45 @@ def test_root_mega_file_creation(mock_conn, monkeypatch):
         "ENV_FILES_PATTERNS": "",
     }
 
-    with patch.dict(os.environ, test_secrets, clear=False):
-        config.load()
-        # Force these values and a predictable subdir
-        config.ENV_FILES_GENERATE = True
-        config.ENV_FILES_CREATE_ROOT = True
-        config.ENV_FILES_STRUCTURE = "flat"
-        config.ENV_FILES_PATTERNS = []
-        config.GIT_SUBDIR = "/testing"
+    # Only the settings generate_env_files reads are patched (and restored afterwards),
+    # rather than reloading the whole config from the environment
+    monkeypatch.setattr(config, "ENV_FILES_GENERATE", True)
+    monkeypatch.setattr(config, "ENV_FILES_CREATE_ROOT", True)
+    monkeypatch.setattr(config, "ENV_FILES_STRUCTURE", "flat")
+    monkeypatch.setattr(config, "ENV_FILES_PATTERNS", [])
+    monkeypatch.setattr(config, "GIT_SUBDIR", "/testing")
+
+    with patch.dict(os.environ, test_secrets, clear=False), patch(
+        "src.env_manager.create_env_files"
+    ) as mock_create:
+        generate_env_files(mock_conn)
+
+        # All files are written in a single batch
+        assert mock_create.call_count == 1
+        files = mock_create.call_args[0][1]
+
+        # We expect .env.app, .env.db and root .env
+        assert len(files) >= 3
 
-        with patch("src.env_manager.create_env_file") as mock_create:
-            generate_env_files(mock_conn)
+        # Look for the root .env in our testing subdir
+        assert "/testing/.env" in files
+        merged_content = files["/testing/.env"]
+        assert "APP_V1=val1" in merged_content
+        assert "DB_V2=val2" in merged_content
 
-            # We expect .env.app, .env.db and root .env
-            assert mock_create.call_count >= 3
 
-            # Look for the root .env in our testing subdir
-            root_calls = [c for c in mock_create.call_args_list if c[0][1] == "/testing/.env"]
-            assert len(root_calls) == 1
-            merged_content = root_calls[0][0][2]
-            assert "APP_V1=val1" in merged_content
-            assert "DB_V2=val2" in merged_content
+def test_file_structure_resolved_once(mock_conn, monkeypatch):
+    monkeypatch.setattr(config, "ENV_FILES_GENERATE", True)
+    monkeypatch.setattr(config, "ENV_FILES_CREATE_ROOT", False)
+    env_file_data = {".env.app": "A=1", ".env.db": "B=2", ".env.redis": "C=3"}
+
+    with patch("src.env_manager.detect_environment_secrets", return_value=env_file_data), patch(
+        "src.env_manager.determine_file_structure", return_value={}
+    ) as mock_structure, patch("src.env_manager.create_env_files"):
+        generate_env_files(mock_conn)
+
+    mock_structure.assert_called_once()
+    assert mock_structure.call_args[0][1] == list(env_file_data)
 
 
 def test_heredoc_escaping(mock_conn):
@@ -87,29 +128,69 @@ def test_heredoc_escaping(mock_conn):
         assert mock_run.call_count == 1
         cmd = mock_run.call_args[0][1]
         assert "mkdir -p" in cmd
-        assert "echo" in cmd
+        assert "umask 177" in cmd
         assert "chmod 600" in cmd
-        assert "base64 -d" in cmd
         assert mock_run.call_args[1].get("use_shell_profile") is False
+        # Content travels over stdin, never on the command line
+        assert "PORT=3000" not in cmd
+        assert mock_run.call_args[1]["in_stream"].read() == "PORT=3000\nDEBUG=true"
+
+
+def test_create_env_files_single_batch(mock_conn, tmp_path):
+    files = {
+        str(tmp_path / ".envs/dev/.env.app"): "PORT=3000\nQUOTE='a \"b\"'",
+        str(tmp_path / ".env"): "KEY=$HOME `x`",
+        str(tmp_path / ".env.empty"): "",
+    }
+    with patch("src.env_manager.run_command") as mock_run:
+        create_env_files(mock_conn, files)
+
+        assert mock_run.call_count == 1
+        assert mock_run.call_args[0][1] == "bash -s"
+        script = mock_run.call_args[1]["in_stream"].read()
+
+    # Run the generated script locally to check it reproduces the exact content
+    subprocess.run(["bash", "-s"], input=script, text=True, check=True)
+    for path, content in files.items():
+        if content:
+            assert open(path).read() == content
+            assert os.stat(path).st_mode & 0o777 == 0o600
+        else:
+            assert not os.path.exists(path)
+
+
+def test_create_env_files_fails_on_first_file(mock_conn, tmp_path):
+    """A failed write of any file fails the whole batch, not just a failure on the last one"""
+    (tmp_path / "blocker").write_text("")
+    files = {
+        str(tmp_path / "blocker" / "dev" / ".env.app"): "PORT=3000",
+        str(tmp_path / ".env"): "KEY=1",
+    }
+    with patch("src.env_manager.run_command") as mock_run:
+        create_env_files(mock_conn, files)
+        script = mock_run.call_args[1]["in_stream"].read()
+
+    result = subprocess.run(["bash", "-s"], input=script, text=True, capture_output=True)
+    assert result.returncode != 0
+    assert not (tmp_path / ".env").exists()
 
 
-def test_mixed_blob_and_raw_bucketing(mocker):
+def test_mixed_blob_and_raw_bucketing(monkeypatch):
     """Regression test for user's mixed secret setup (toJSON blob + raw block)."""
     # Setup: ENV is a raw block with comments
     mock_raw = "# Comments\nA=1\nB=2"
 
     # Isolate os.environ to avoid pollution from other tests
-    mocker.patch(
-        "os.environ",
+    monkeypatch.setattr(
+        os,
+        "environ",
         {"ENV": mock_raw, "ENV_APP": "C=3", "ENV_FILES_GENERATE": "true", "ENVIRONMENT": "dev"},
     )
 
     # Patch the config object directly
-    from src.env_manager import config
-
-    mocker.patch.object(config, "ENVIRONMENT", "dev")
-    mocker.patch.object(config, "ENV_FILES_STRUCTURE", "single")
-    mocker.patch.object(config, "ENV_FILES_GENERATE", True)
+    monkeypatch.setattr(config, "ENVIRONMENT", "dev")
+    monkeypatch.setattr(config, "ENV_FILES_STRUCTURE", "single")
+    monkeypatch.setattr(config, "ENV_FILES_GENERATE", True)
 
     result = detect_environment_secrets()
 
@@ -120,3 +201,39 @@ def test_mixed_blob_and_raw_bucketing(mocker):
     assert "B=2" in result[".env"]
     assert "APP_C=3" in result[".env"]
     assert "OTHER_UNRELATED" not in result[".env"]
+
+
+def test_component_files_from_buckets(monkeypatch):
+    """Each component file gets its base, env-specific and blob variables, nothing else"""
+    monkeypatch.setattr(config, "ENVIRONMENT", "prod")
+    monkeypatch.setattr(config, "ENV_FILES_STRUCTURE", "nested")
+    monkeypatch.setattr(config, "ENV_FILES_PATTERNS", None)
+    env_vars = {
+        "ENV_APP_PORT": "8000",
+        "ENV_PROD_APP": "PORT=9000\nDEBUG=0",
+        "ENV_DB_HOST": "db",
+        "ENV_PROD_DB_HOST": "prod-db",
+        "ENV_STAGING_DB_HOST": "staging-db",
+    }
+
+    result = detect_environment_secrets(env_vars)
+
+    assert result[".env.app"] == "PORT=9000\nDEBUG=0"
+    assert result[".env.db"] == "HOST=prod-db"
+
+
+def test_blob_parsed_once_per_run():
+    from src import env_manager
+
+    blob_cache = {}
+    env_vars = {"ENV_APP": "PORT=80\nHOST=a"}
+    with patch.object(
+        env_manager, "parse_all_in_one_secret", wraps=parse_all_in_one_secret
+    ) as mock_parse:
+        first = merge_env_vars_by_priority(env_vars, "dev", ".env", blob_cache)
+        second = merge_env_vars_by_priority(env_vars, "dev", ".env", blob_cache)
+
+    assert first == second == {"APP_PORT": "80", "APP_HOST": "a"}
+    mock_parse.assert_called_once()
+    # Nothing is kept across runs: a fresh parse returns a new dict
+    assert parse_all_in_one_secret("A=1") is not parse_all_in_one_secret("A=1")
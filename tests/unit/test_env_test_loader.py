@@ -0,0 +1,18 @@
+import pytest
+
+from tests.conftest import ENV_LINE
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("KEY=value", [("KEY", "value")]),
+        ("  KEY = value  ", [("KEY", "value")]),
+        ("# FOO=bar", []),
+        ("  # FOO=bar", []),
+        ("\t#FOO=bar\nBAR=1", [("BAR", "1")]),
+        ("\n   \nURL=a=b", [("URL", "a=b")]),
+    ],
+)
+def test_env_test_lines(text, expected):
+    assert ENV_LINE.findall(text) == expected
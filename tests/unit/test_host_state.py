@@ -0,0 +1,43 @@
+from unittest.mock import patch
+
+from src import host_state
+from src.config import config
+
+
+def test_record_and_get_installed():
+    assert host_state.get_installed("h1", ["docker", "helm"]) == set()
+    host_state.record_installed("h1", ["docker", "helm"])
+    assert host_state.get_installed("h1", ["docker", "helm", "k3s"]) == {"docker", "helm"}
+    # State is per host
+    assert host_state.get_installed("h2", ["docker"]) == set()
+
+
+def test_installed_state_expires():
+    host_state.record_installed("h1", ["docker"])
+    with patch("src.host_state.time.time", return_value=10**12):
+        assert host_state.get_installed("h1", ["docker"]) == set()
+
+
+def test_forget_installed():
+    host_state.record_installed("h1", ["docker", "helm"])
+    host_state.forget_installed("h1", ["docker"])
+    assert host_state.get_installed("h1", ["docker", "helm"]) == {"helm"}
+
+
+def test_cache_disabled_or_unwritable(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "HOST_STATE_CACHE", "")
+    host_state.record_installed("h1", ["docker"])
+    assert host_state.get_installed("h1", ["docker"]) == set()
+
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    monkeypatch.setattr(config, "HOST_STATE_CACHE", str(blocker / "state.sqlite"))
+    host_state.record_installed("h1", ["docker"])
+    assert host_state.get_installed("h1", ["docker"]) == set()
+
+
+def test_relative_cache_path(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, "HOST_STATE_CACHE", "state.sqlite")
+    host_state.record_installed("h1", ["docker"])
+    assert host_state.get_installed("h1", ["docker"]) == {"docker"}
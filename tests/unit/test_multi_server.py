@@ -1,3 +1,4 @@
+import threading
 from unittest.mock import MagicMock, patch
 
 import pytest
@@ -8,7 +9,7 @@ from src.config import config
 
 @pytest.fixture
 def mock_executor():
-    with patch("concurrent.futures.ProcessPoolExecutor") as mock_pool:
+    with patch("concurrent.futures.ThreadPoolExecutor") as mock_pool:
         executor_instance = MagicMock()
         mock_pool.return_value.__enter__.return_value = executor_instance
         yield executor_instance
@@ -28,7 +29,7 @@ def test_single_host_direct_call(monkeypatch):
         mock_single.assert_called_once()
 
     # Check with Executor mocked - should NOT be called
-    with patch("concurrent.futures.ProcessPoolExecutor") as mock_pool, patch(
+    with patch("concurrent.futures.ThreadPoolExecutor") as mock_pool, patch(
         "src.orchestrator.deploy_single_host"
     ) as mock_single:
         orchestrator.handle_connection()
@@ -86,14 +87,81 @@ def test_multi_host_distribution(monkeypatch, mock_executor):
     assert args3[1]["REMOTE_USER"] == "u2"
 
 
-def test_worker_reloads_config(monkeypatch):
-    """Test that the worker function reloads config."""
-    # We can't easily test cross-process state here, but we can verify the function calls config.load
-    with patch.object(config, "load") as mock_load, patch(
-        "src.orchestrator.deploy_single_host"
-    ) as mock_deploy:
-        overrides = {"REMOTE_HOST": "test-host"}
-        orchestrator.deploy_worker(overrides)
+def test_worker_binds_thread_config(monkeypatch):
+    """Test that the worker deploys with its own overrides without touching the global config."""
+    monkeypatch.setattr(config, "REMOTE_HOST", "global-host")
+    seen = []
+
+    with patch(
+        "src.orchestrator.deploy_single_host", side_effect=lambda: seen.append(config.REMOTE_HOST)
+    ):
+        orchestrator.deploy_worker({"REMOTE_HOST": "test-host"})
+
+    assert seen == ["test-host"]
+    assert config.REMOTE_HOST == "global-host"
+
+
+def test_worker_threads_isolated():
+    """Test that concurrent workers each see their own host."""
+    barrier = threading.Barrier(2)
+    seen = {}
+
+    def fake_deploy():
+        barrier.wait(timeout=5)
+        seen[threading.current_thread().name] = config.REMOTE_HOST
+
+    with patch("src.orchestrator.deploy_single_host", side_effect=fake_deploy):
+        threads = [
+            threading.Thread(target=orchestrator.deploy_worker, args=({"REMOTE_HOST": h},), name=h)
+            for h in ("h1", "h2")
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    assert seen == {"h1": "h1", "h2": "h2"}
+
+
+def test_multi_host_failures_aggregated(monkeypatch):
+    """Test that one failing host doesn't stop the others from being reported."""
+    monkeypatch.setattr(config, "REMOTE_HOST", "h1,h2,h3")
+    deployed = []
+
+    def fake_worker(overrides):
+        deployed.append(overrides["REMOTE_HOST"])
+        if overrides["REMOTE_HOST"] == "h2":
+            raise ValueError("boom")
+
+    with patch("src.orchestrator.deploy_worker", side_effect=fake_worker):
+        with pytest.raises(RuntimeError, match="failed on 1 of 3 hosts: h2") as exc_info:
+            orchestrator.handle_connection()
+
+    assert sorted(deployed) == ["h1", "h2", "h3"]
+    assert isinstance(exc_info.value.__cause__, ValueError)
+
+
+def test_multi_host_results_reported_as_completed(monkeypatch, capsys):
+    """Test that a fast host is reported without waiting on a slow one."""
+    monkeypatch.setattr(config, "REMOTE_HOST", "slow,fast")
+    fast_reported = threading.Event()
+
+    def fake_worker(overrides):
+        if overrides["REMOTE_HOST"] == "slow":
+            # Only finish once the fast host's completion has been handled
+            assert fast_reported.wait(timeout=5)
+
+    real_print = print
+
+    def spy_print(*args, **kwargs):
+        real_print(*args, **kwargs)
+        if args and "fast succeeded" in str(args[0]):
+            fast_reported.set()
+
+    with patch("src.orchestrator.deploy_worker", side_effect=fake_worker), patch(
+        "builtins.print", side_effect=spy_print
+    ):
+        orchestrator.handle_connection()
 
-        mock_load.assert_called_with(overrides)
-        mock_deploy.assert_called_once()
+    out = capsys.readouterr().out
+    assert out.index("fast succeeded") < out.index("slow succeeded")
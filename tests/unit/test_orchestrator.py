@@ -1,7 +1,10 @@
-from unittest.mock import Mock, patch
+from contextlib import nullcontext
+from unittest.mock import DEFAULT, Mock, patch
 
 import pytest
 from fabric import Connection
+from invoke import Result
+from invoke.exceptions import UnexpectedExit
 
 from src import orchestrator
 from src.config import config
@@ -17,12 +20,27 @@ def mock_conn_class():
 def mock_conn():
     conn = Mock(spec=Connection)
     conn.run.return_value = Mock(stdout="test-host", ok=True)
-    conn.cd.return_value.__enter__ = Mock(return_value=None)
-    conn.cd.return_value.__exit__ = Mock(return_value=None)
+    conn.cd.return_value = nullcontext()
     return conn
 
 
-def test_handle_connection_flow(mock_conn_class, mock_conn, monkeypatch, tmp_path):
+@pytest.fixture
+def patched_steps(monkeypatch):
+    """Neutralize the per-host setup steps and deploy run around handle_connection"""
+    # Plain stand-ins: no test inspects these calls, so no Mock bookkeeping is needed
+    for name in (
+        "setup_ssh_key",
+        "setup_git_auth",
+        "install_dependencies",
+        "clone_repo",
+        "copy_artifacts",
+        "generate_env_files",
+        "deploy",
+    ):
+        monkeypatch.setattr(orchestrator, name, lambda *args, **kwargs: None)
+
+
+def test_handle_connection_flow(mock_conn_class, mock_conn, patched_steps, monkeypatch, tmp_path):
     # Setup
     monkeypatch.setattr(config, "REMOTE_HOST", "1.2.3.4")
     monkeypatch.setattr(config, "ENV_FILES_GENERATE", True)
@@ -33,16 +51,7 @@ def test_handle_connection_flow(mock_conn_class, mock_conn, monkeypatch, tmp_pat
 
     mock_conn_class.return_value = mock_conn
 
-    # Mocking all dependencies
-    with (
-        patch("src.orchestrator.setup_ssh_key"),
-        patch("src.orchestrator.setup_git_auth"),
-        patch("src.orchestrator.install_dependencies"),
-        patch("src.orchestrator.clone_repo"),
-        patch("src.orchestrator.generate_env_files"),
-        patch("src.orchestrator.deploy"),
-    ):
-        orchestrator.handle_connection()
+    orchestrator.handle_connection()
 
     # Verify outputs
     content = github_output.read_text()
@@ -50,28 +59,135 @@ def test_handle_connection_flow(mock_conn_class, mock_conn, monkeypatch, tmp_pat
     assert "deployment_status=success" in content
 
 
-def test_deploy_routing(monkeypatch, mock_conn):
-    # 1. Test custom deploy command
-    monkeypatch.setattr(config, "DEPLOY_COMMAND", "echo hello")
-    with patch("src.orchestrator.run_command") as mock_run:
-        orchestrator.deploy(mock_conn)
-        assert "echo hello" in mock_run.call_args[0][1]
-
-    # 2. Test barefoot routing
+@pytest.fixture
+def deploy_targets():
+    """Patch every route out of deploy(), yielding {name: mock}"""
+    with patch.multiple(
+        "src.orchestrator",
+        run_command=DEFAULT,
+        deploy_baremetal=DEFAULT,
+        deploy_docker=DEFAULT,
+        deploy_k8s=DEFAULT,
+    ) as mocks:
+        yield mocks
+
+
+@pytest.mark.parametrize(
+    "deployment_type,target",
+    [
+        ("baremetal", "deploy_baremetal"),
+        ("docker", "deploy_docker"),
+        ("k8s", "deploy_k8s"),
+    ],
+)
+def test_deploy_routing(monkeypatch, mock_conn, deploy_targets, deployment_type, target):
     monkeypatch.setattr(config, "DEPLOY_COMMAND", None)
-    monkeypatch.setattr(config, "DEPLOYMENT_TYPE", "baremetal")
-    with patch("src.orchestrator.deploy_baremetal") as mock_bm:
-        orchestrator.deploy(mock_conn)
-        mock_bm.assert_called_once()
+    monkeypatch.setattr(config, "DEPLOYMENT_TYPE", deployment_type)
+    orchestrator.deploy(mock_conn)
+    for name, mock in deploy_targets.items():
+        if name == target:
+            mock.assert_called_once_with(mock_conn)
+        else:
+            mock.assert_not_called()
 
-    # 3. Test docker routing
+
+def test_deploy_custom_command(monkeypatch, mock_conn, deploy_targets):
+    monkeypatch.setattr(config, "DEPLOY_COMMAND", "echo hello")
     monkeypatch.setattr(config, "DEPLOYMENT_TYPE", "docker")
-    with patch("src.orchestrator.deploy_docker") as mock_dk:
-        orchestrator.deploy(mock_conn)
-        mock_dk.assert_called_once()
+    orchestrator.deploy(mock_conn)
+    assert "echo hello" in deploy_targets["run_command"].call_args[0][1]
+    deploy_targets["deploy_docker"].assert_not_called()
+
 
-    # 4. Test k8s routing
+def test_install_tools_probed_once(mock_conn_class, mock_conn, patched_steps, monkeypatch):
+    monkeypatch.setattr(config, "REMOTE_HOST", "1.2.3.4")
+    monkeypatch.setattr(config, "DEPLOYMENT_TYPE", "k8s")
+    monkeypatch.setattr(config, "ENV_FILES_GENERATE", False)
+    monkeypatch.delenv("GITHUB_OUTPUT", raising=False)
+    mock_conn_class.return_value = mock_conn
+
+    with (
+        patch("src.orchestrator.probe_installed", return_value={"docker", "helm"}) as mock_probe,
+        patch("src.orchestrator.install_docker") as mock_docker,
+        patch("src.orchestrator.install_kubectl") as mock_kubectl,
+        patch("src.orchestrator.install_helm") as mock_helm,
+        patch("src.orchestrator.install_k3s") as mock_k3s,
+    ):
+        orchestrator.handle_connection()
+
+    mock_probe.assert_called_once_with(mock_conn, ["docker", "k3s", "helm", "kubectl"])
+    mock_docker.assert_not_called()
+    mock_helm.assert_not_called()
+    mock_kubectl.assert_called_once_with(mock_conn)
+    mock_k3s.assert_called_once_with(mock_conn)
+
+
+def test_k3s_installed_before_kubectl(mock_conn_class, mock_conn, patched_steps, monkeypatch):
+    monkeypatch.setattr(config, "REMOTE_HOST", "1.2.3.4")
     monkeypatch.setattr(config, "DEPLOYMENT_TYPE", "k8s")
-    with patch("src.orchestrator.deploy_k8s") as mock_k8s:
-        orchestrator.deploy(mock_conn)
-        mock_k8s.assert_called_once()
+    monkeypatch.setattr(config, "ENV_FILES_GENERATE", False)
+    monkeypatch.delenv("GITHUB_OUTPUT", raising=False)
+    mock_conn_class.return_value = mock_conn
+    order = []
+    monkeypatch.setattr(orchestrator, "install_k3s", lambda c: order.append("k3s"))
+    monkeypatch.setattr(orchestrator, "install_kubectl", lambda c: order.append("kubectl"))
+
+    with (
+        patch("src.orchestrator.probe_installed", return_value=set()),
+        patch("src.orchestrator.install_docker"),
+        patch("src.orchestrator.install_helm"),
+    ):
+        orchestrator.handle_connection()
+
+    assert order == ["k3s", "kubectl"]
+
+
+def test_cached_tools_skip_probe(mock_conn_class, mock_conn, patched_steps, monkeypatch):
+    monkeypatch.setattr(config, "REMOTE_HOST", "1.2.3.4")
+    monkeypatch.setattr(config, "DEPLOYMENT_TYPE", "docker")
+    monkeypatch.setattr(config, "ENV_FILES_GENERATE", False)
+    monkeypatch.delenv("GITHUB_OUTPUT", raising=False)
+    mock_conn_class.return_value = mock_conn
+
+    with (
+        patch("src.orchestrator.probe_installed", return_value=set()) as mock_probe,
+        patch("src.orchestrator.install_docker") as mock_docker,
+    ):
+        orchestrator.handle_connection()
+        orchestrator.handle_connection()
+
+    # Second deploy trusts the recorded install and never probes the host
+    mock_probe.assert_called_once_with(mock_conn, ["docker"])
+    mock_docker.assert_called_once_with(mock_conn)
+
+
+def test_cached_tools_not_restamped(mock_conn_class, mock_conn, patched_steps, monkeypatch):
+    monkeypatch.setattr(config, "REMOTE_HOST", "1.2.3.4")
+    monkeypatch.setattr(config, "DEPLOYMENT_TYPE", "docker")
+    monkeypatch.setattr(config, "ENV_FILES_GENERATE", False)
+    monkeypatch.delenv("GITHUB_OUTPUT", raising=False)
+    mock_conn_class.return_value = mock_conn
+
+    with (
+        patch("src.orchestrator.host_state.get_installed", return_value={"docker"}),
+        patch("src.orchestrator.host_state.record_installed") as mock_record,
+        patch("src.orchestrator.probe_installed") as mock_probe,
+    ):
+        orchestrator.handle_connection()
+
+    # A cache hit must not refresh its own timestamp, or the TTL would never expire
+    mock_probe.assert_not_called()
+    mock_record.assert_called_once_with("1.2.3.4", [])
+
+
+def test_deploy_command_exit_code(monkeypatch, mock_conn):
+    monkeypatch.setattr(config, "DEPLOY_COMMAND", "./release.sh")
+    failure = UnexpectedExit(Result(command="./release.sh", exited=3))
+    with (
+        patch("src.orchestrator.fix_database_permissions"),
+        patch("src.orchestrator.run_command", side_effect=failure) as mock_run,
+    ):
+        with pytest.raises(ValueError, match="Deploy command failed with exit code: 3"):
+            orchestrator.deploy(mock_conn)
+    # The user's command is sent as-is, without an exit-code echo wrapper
+    assert mock_run.call_args[0][1] == "./release.sh"
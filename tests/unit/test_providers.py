@@ -1,53 +1,51 @@
 from unittest.mock import Mock, patch
 
 import pytest
-from fabric import Connection
 
 from src.config import config
 from src.providers import baremetal, docker, k8s
 
 
-@pytest.fixture
-def mock_conn():
-    conn = Mock(spec=Connection)
-    conn.run.return_value = Mock(stdout="", ok=True)
-    conn.cd.return_value.__enter__ = Mock(return_value=None)
-    conn.cd.return_value.__exit__ = Mock(return_value=None)
-    return conn
-
-
 class TestBaremetal:
     def test_deploy_sh_flow(self, mock_conn):
-        def mock_run(cmd, **kwargs):
-            if "test -f deploy.sh" in cmd:
-                return Mock(ok=True)
-            return Mock(ok=False)
-
-        mock_conn.run.side_effect = mock_run
+        mock_conn.run.side_effect = [
+            Mock(ok=True),  # test -f deploy.sh
+            Mock(ok=True),  # chmod +x deploy.sh
+        ]
 
         with patch("src.providers.baremetal.run_command") as mock_run_cmd:
             baremetal.deploy_baremetal(mock_conn)
             assert "./deploy.sh" in mock_run_cmd.call_args[0][1]
+        assert mock_conn.run.call_args_list[0][0][0] == "test -f deploy.sh"
 
     def test_makefile_fallback(self, mock_conn, monkeypatch):
         monkeypatch.setattr(config, "ENVIRONMENT", "staging")
 
         # deploy.sh no, Makefile yes
-        def mock_run(cmd, **kwargs):
-            if "test -f deploy.sh" in cmd:
-                return Mock(ok=False)
-            if "test -f Makefile" in cmd:
-                return Mock(ok=True)
-            return Mock(ok=False)
-
-        mock_conn.run.side_effect = mock_run
+        mock_conn.run.side_effect = [
+            Mock(ok=False),  # test -f deploy.sh
+            Mock(ok=True),  # test -f Makefile
+        ]
 
         with patch("src.providers.baremetal.run_command") as mock_run_cmd:
             baremetal.deploy_baremetal(mock_conn)
             assert "make staging" in mock_run_cmd.call_args[0][1]
+        assert [c[0][0] for c in mock_conn.run.call_args_list] == [
+            "test -f deploy.sh",
+            "test -f Makefile",
+        ]
 
 
 class TestDocker:
+    def test_install_docker_single_exec(self, mock_conn):
+        mock_conn.run.return_value = Mock(stdout="")
+        with patch("src.providers.docker.run_command") as mock_run_cmd:
+            docker.install_docker(mock_conn)
+        mock_run_cmd.assert_called_once()
+        script = mock_run_cmd.call_args[0][1]
+        assert script.startswith("apt-get update && ")
+        assert script.endswith("systemctl start docker")
+
     def test_docker_login_ghcr(self, mock_conn, monkeypatch):
         monkeypatch.setattr(config, "GIT_USER", "u")
         monkeypatch.setattr(config, "GIT_TOKEN", "t")
@@ -65,32 +63,102 @@ class TestDocker:
 
 
 class TestK8s:
-    def test_k3s_installation(self, mock_conn):
+    @pytest.fixture
+    def patched_k8s(self):
+        """k8s's docker_login and run_command patched in one place: (mock_login, mock_run_cmd)"""
+        with patch("src.providers.k8s.docker_login") as mock_login, patch(
+            "src.providers.k8s.run_command"
+        ) as mock_run_cmd:
+            yield mock_login, mock_run_cmd
+
+    def test_kubectl_version_cached_locally(self, mock_conn, patched_k8s):
+        response = Mock()
+        response.read.return_value = b"v1.30.1\n"
+        response.__enter__ = Mock(return_value=response)
+        response.__exit__ = Mock(return_value=None)
+
+        with patch("urllib.request.urlopen", return_value=response) as mock_urlopen:
+            assert k8s.resolve_kubectl_version() == "v1.30.1"
+            assert k8s.resolve_kubectl_version() == "v1.30.1"
+        mock_urlopen.assert_called_once()
+
+        mock_conn.run.side_effect = [Mock(stdout=""), Mock(ok=True)]
+        k8s.install_kubectl(mock_conn)
+        assert "/release/v1.30.1/bin/linux/amd64/kubectl" in mock_conn.run.call_args[0][0]
+
+    def test_kubectl_version_falls_back_to_remote(self, mock_conn, patched_k8s):
+        mock_conn.run.side_effect = [Mock(stdout=""), Mock(ok=True)]
+        with patch("urllib.request.urlopen", side_effect=OSError("offline")):
+            k8s.install_kubectl(mock_conn)
+        assert "$(curl -s " in mock_conn.run.call_args[0][0]
+
+    @pytest.mark.parametrize("cached", ["v1.30.1; rm -rf /", "latest", ""])
+    def test_kubectl_version_rejects_bad_tags(self, mock_conn, patched_k8s, cached, tmp_path):
+        (tmp_path / "kubectl_stable.txt").write_text(cached)
+        response = Mock()
+        response.read.return_value = b'v1.30.1"$(id)'
+        response.__enter__ = Mock(return_value=response)
+        response.__exit__ = Mock(return_value=None)
+
+        # Neither the cached nor the fetched value is a plain tag, so the host fallback is used
+        with patch("urllib.request.urlopen", return_value=response):
+            assert k8s.resolve_kubectl_version() is None
+            mock_conn.run.side_effect = [Mock(stdout=""), Mock(ok=True)]
+            k8s.install_kubectl(mock_conn)
+        assert "$(curl -s " in mock_conn.run.call_args[0][0]
+        assert "$(id)" not in mock_conn.run.call_args[0][0]
+
+    def test_k3s_installation(self, mock_conn, patched_k8s):
+        _, mock_run_cmd = patched_k8s
         mock_conn.run.side_effect = [
             Mock(stdout=""),  # which k3s -> not found
-            Mock(ok=True),  # curl k3s sh
-            Mock(ok=True),  # systemctl enable
-            Mock(ok=True),  # systemctl start
-            Mock(ok=True),  # echo KUBECONFIG
+            Mock(ok=True),  # curl k3s sh + KUBECONFIG export
         ]
-        with patch("src.providers.k8s.run_command"):
-            k8s.install_k3s(mock_conn)
-        assert mock_conn.run.call_count >= 3
-
-    def test_k8s_deploy_namespace_creation(self, mock_conn, monkeypatch):
+        k8s.install_k3s(mock_conn)
+        assert mock_conn.run.call_count == 2
+        assert "KUBECONFIG" in mock_conn.run.call_args[0][0]
+        mock_run_cmd.assert_called_once_with(
+            mock_conn, "systemctl enable --now k3s", force_sudo=True
+        )
+
+    def test_helm_password_install_single_exec(self, mock_conn, monkeypatch):
+        monkeypatch.setattr(config, "REMOTE_PASSWORD", "pa'ss")
+        mock_conn.run.side_effect = [Mock(stdout=""), Mock(ok=True)]
+        k8s.install_helm(mock_conn)
+        script = mock_conn.run.call_args[0][0]
+        first_line, body = script.split("\n", 1)
+        assert first_line.startswith("cat > /tmp/helm-askpass.sh << 'HELMASKPASS_EOF' && ")
+        assert "SUDO_ASKPASS=/tmp/helm-askpass.sh" in first_line
+        assert body.endswith("\nHELMASKPASS_EOF")
+
+    def test_k8s_deploy_namespace_creation(self, mock_conn, monkeypatch, patched_k8s):
         monkeypatch.setattr(config, "K8S_NAMESPACE", "custom-ns")
         monkeypatch.setattr(config, "K8S_MANIFEST_PATH", "k8s/")
         monkeypatch.setattr(config, "GIT_SUBDIR", "/app")
 
         mock_conn.run.side_effect = [
-            Mock(ok=True),  # test -d k8s
-            Mock(ok=True),  # create namespace
-            Mock(ok=True),  # apply -f k8s/
+            Mock(ok=True),  # create namespace + apply -f k8s/
         ]
 
-        with patch("src.providers.k8s.docker_login"):
-            k8s.deploy_k8s(mock_conn)
+        k8s.deploy_k8s(mock_conn)
 
-        calls = [str(call) for call in mock_conn.run.call_args_list]
+        calls = [c[0][0] for c in mock_conn.run.call_args_list]
         assert any("kubectl create namespace custom-ns" in c for c in calls)
         assert any("kubectl apply -f k8s/" in c for c in calls)
+        # Namespace + apply share one exec and one KUBECONFIG export
+        assert len(calls) == 1
+        assert calls[0].count("export KUBECONFIG=") == 1
+
+    def test_k8s_manifest_discovery_single_probe(self, mock_conn, monkeypatch, patched_k8s):
+        monkeypatch.setattr(config, "K8S_MANIFEST_PATH", None)
+        monkeypatch.setattr(config, "GIT_SUBDIR", "/app")
+
+        mock_conn.run.side_effect = [
+            Mock(ok=True, stdout="manifests\n"),  # discovery probe
+            Mock(ok=True),  # create namespace + apply
+        ]
+
+        k8s.deploy_k8s(mock_conn)
+
+        assert mock_conn.run.call_count == 2
+        assert "kubectl apply -f manifests -n" in mock_conn.run.call_args[0][0]